@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of flow.py, without GitHub.
+
+Creates a local bare repository with some history, serves it over http with dulwich.web (reading and pushing), and
+runs flow.py against it, each time in its own process:
+- temporary: full clone in a temporary directory on each run, as flow.py used to do,
+- mirror (cold): first run with a mirror, shallow clone,
+- mirror (warm): next runs, only fetching what was pushed since.
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.repo import Repo
+from dulwich.server import DictBackend
+from dulwich.web import make_server, make_wsgi_chain, WSGIRequestHandlerLogger, WSGIServerLogger
+
+
+def make_repo(path, nb_files, nb_commits, file_size, seed=42):
+    """
+    Bare repository with nb_files files in a few directories, each commit changing a tenth of them.
+    """
+    rnd = random.Random(seed)
+    repo = Repo.init_bare(path, mkdir=True)
+    files = {}
+    parent = None
+    for c in range(nb_commits):
+        for i in rnd.sample(range(nb_files), max(1, nb_files // 10)) if files else range(nb_files):
+            files[i] = Blob.from_string(rnd.getrandbits(8 * file_size).to_bytes(file_size, 'little'))
+            repo.object_store.add_object(files[i])
+
+        dirs = {}
+        for i, blob in files.items():
+            dirs.setdefault('dir{}'.format(i % 10), Tree()).add('file{}'.format(i).encode(), 0o100644, blob.id)
+        root = Tree()
+        for name, tree in dirs.items():
+            repo.object_store.add_object(tree)
+            root.add(name.encode(), 0o040000, tree.id)
+        repo.object_store.add_object(root)
+
+        commit = Commit()
+        commit.tree = root.id
+        commit.parents = [parent] if parent else []
+        commit.author = commit.committer = b'bench <bench@example.com>'
+        commit.author_time = commit.commit_time = 1600000000 + c
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.message = 'Commit {}.'.format(c).encode()
+        repo.object_store.add_object(commit)
+        parent = commit.id
+
+    repo.refs[b'refs/heads/master'] = parent
+    return repo
+
+
+def serve(repo):
+    """
+    Serves repo over http on a free port, in a background thread.
+
+    :returns: url of the repo.
+    """
+    server = make_server(
+        'localhost', 0, make_wsgi_chain(DictBackend({'/': repo})),
+        handler_class=WSGIRequestHandlerLogger, server_class=WSGIServerLogger
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://localhost:{}/'.format(server.server_port)
+
+
+def run(url, mirror, depth):
+    start = time.perf_counter()
+    p = subprocess.run(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flow.py')],
+        env=dict(os.environ, FLOW_GITURL=url, FLOW_MIRROR=mirror, FLOW_DEPTH=depth),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    elapsed = time.perf_counter() - start
+    if p.returncode:
+        raise Exception('flow.py failed:\n' + p.stdout.decode(errors='replace'))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks flow.py against a local repository.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--files', dest='files', type=int, default=2000, help='Number of files in the repository.')
+    parser.add_argument('--commits', dest='commits', type=int, default=50, help='Number of commits of history.')
+    parser.add_argument('--size', dest='size', type=int, default=4096, help='Size of each file version, in bytes.')
+    parser.add_argument('--runs', dest='runs', type=int, default=3, help='Runs per mode.')
+    parser.add_argument('--depth', dest='depth', type=str, default='1', help='Depth of the mirror, empty for all.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='flow-bench-')
+    start = time.perf_counter()
+    repo = make_repo(os.path.join(workdir, 'remote.git'), args.files, args.commits, args.size)
+    print('{} files, {} commits generated in {:.1f}s.'.format(args.files, args.commits, time.perf_counter() - start))
+    url = serve(repo)
+    mirror = os.path.join(workdir, 'mirror')
+
+    print('{:>15} {}'.format('mode', 'seconds per run'))
+    print('{:>15} {}'.format('temporary', ' '.join(
+        '{:.2f}'.format(run(url, '', '')) for _ in range(args.runs))))
+    print('{:>15} {:.2f}'.format('mirror (cold)', run(url, mirror, args.depth)))
+    print('{:>15} {}'.format('mirror (warm)', ' '.join(
+        '{:.2f}'.format(run(url, mirror, args.depth)) for _ in range(args.runs))))
+
+
+if __name__ == '__main__':
+    main()
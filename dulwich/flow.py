@@ -1,16 +1,24 @@
 from os import environ
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from time import perf_counter
 
 from dulwich import porcelain
 from dulwich.repo import Repo
 from urllib3 import ProxyManager
 
-## Configuration settings:
+## Configuration settings (each one can be overridden by an environment variable of the same name prefixed by FLOW_):
 # Source url of the repo (Note: https here. ssh would work as well, a bit differently).
-GITURL = "https://github.com/lomignet/thisdataguy_snippets"
+GITURL = environ.get("FLOW_GITURL", "https://github.com/lomignet/thisdataguy_snippets")
 # Gihthub token: https://docs.github.com/en/github/authenticating-to-github/creating-a-personal-access-token
-TOKEN = "12345blah"
+TOKEN = environ.get("FLOW_TOKEN", "12345blah")
+# Branch to commit on and push to.
+BRANCH = environ.get("FLOW_BRANCH", "master")
+# Local mirror of the repo, kept between runs so that only new objects are fetched. Empty to clone in a temporary
+# directory on every run instead.
+MIRROR = environ.get("FLOW_MIRROR", str(Path.home() / ".cache" / "dulwich_flow" / "thisdataguy_snippets"))
+# Number of commits of history to get, empty for all of them. Only the tree of the last commit is needed to commit.
+DEPTH = int(environ.get("FLOW_DEPTH", "1") or 0) or None
 ## /end of configuration.
 
 # If the environment variable https_proxy exists, we need to tell Dulwich to use a proxy.
@@ -19,44 +27,88 @@ if environ.get("https_proxy", None):
 else:
     pool_manager = None
 
-with TemporaryDirectory() as gitrootdir:
+remote = dict(
+    password=TOKEN,
+    # Tokens are kinda public keys, no need for a username but it still needs to be provided for Dulwich.
+    username="not relevant",
+)
+if pool_manager:
+    remote["pool_manager"] = pool_manager
 
-    # Gotta love operator overloading!
-    gitdir = Path(gitrootdir) / "repo"
+
+def timed(message, start):
+    print("{} in {:.2f}s.".format(message, perf_counter() - start))
+
+
+def clone(gitdir):
     print("Cloning...")
-    repo = porcelain.clone(
-        GITURL,
-        password=TOKEN,
-        # Tokens are kinda public keys, no need for a username but it still needs to be provided for Dulwich.
-        username="not relevant",
-        target=gitdir,
-        checkout=True,
-        pool_manager=pool_manager,
-    )
-    print("Cloned.")
+    start = perf_counter()
+    repo = porcelain.clone(GITURL, target=str(gitdir), checkout=True, depth=DEPTH, **remote)
+    timed("Cloned", start)
+    return repo
+
+
+def update(gitdir):
+    """
+    Fetches what is new in the remote branch and resets the mirror onto it, discarding whatever a previous run left
+    behind (eg. a commit which could not be pushed).
+    """
+    repo = Repo(str(gitdir))
+    print("Fetching...")
+    start = perf_counter()
+    # Only the objects the mirror does not have yet are sent.
+    result = porcelain.fetch(repo, GITURL, depth=DEPTH, **remote)
+    head = result.refs[b"refs/heads/" + BRANCH.encode()]
+    # HEAD is a symbolic ref to the branch, which is moved as well.
+    repo.refs[b"HEAD"] = head
+    # Only the files which changed are written.
+    porcelain.reset(repo, "hard", head)
+    timed("Fetched", start)
+    return repo
+
 
-    # Do something clever with the files in the repo, for instance create an empty readme.
+def change(gitdir):
+    """
+    Do something clever with the files in the repo, for instance create an empty readme.
+
+    :returns: list of the paths to commit.
+    """
     readme = gitdir / "readme.md"
     readme.touch()
-    porcelain.add(repo, readme)
+    return [readme]
+
+
+def flow(gitdir):
+    repo = update(gitdir) if (gitdir / ".git").exists() else clone(gitdir)
+
+    # All the files are staged in one go: the index is read and written once, not once per file.
+    porcelain.add(repo, [str(p) for p in change(gitdir)])
 
     print("Committing...")
     porcelain.commit(repo, "Empty readme added.")
     print("Commited.")
 
     print("Pushing...")
+    start = perf_counter()
     porcelain.push(
         repo,
         remote_location=GITURL,
-        refspecs="master", # branch to push to
-        password=TOKEN,
-        # Token are kinda public keys, no need for a username but it still needs to be provided for Dulwich.
-        username="not relevant",
-        pool_manager=pool_manager,
+        refspecs=BRANCH, # branch to push to
+        **remote,
     )
     # Note: Dulwich 0.20.5 raised an exception here. It could be ignored but it was dirty:
     # File ".../venv/lib/python3.7/site-packages/dulwich/porcelain.py", line 996, in push
     #     (ref, error.encode(err_encoding)))
     # AttributeError: 'NoneType' object has no attribute 'encode'
     # Dulwich 0.20.6 fixed it.
-    print("Pushed.")
+    timed("Pushed", start)
+
+
+if MIRROR:
+    # Gotta love operator overloading!
+    mirror = Path(MIRROR)
+    mirror.parent.mkdir(parents=True, exist_ok=True)
+    flow(mirror)
+else:
+    with TemporaryDirectory() as gitrootdir:
+        flow(Path(gitrootdir) / "repo")
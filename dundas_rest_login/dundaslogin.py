@@ -2,11 +2,16 @@
 
 """
 Skeleton to use Dundas Rest API, with guaranteed log out.
+
+DundasPool keeps a few logged in sessions to share between threads, for scripts doing many calls.
 """
+import concurrent.futures
 import contextlib
 import logging
+import queue
 import requests
 import sys
+import threading
 
 
 class DundasSession:
@@ -72,11 +77,114 @@ class DundasSession:
         else:
             logging.info('Was not yet Logged in.')
 
-logging.basicConfig(level='INFO')
+    def request(self, method, path, **kwargs):
+        """
+        Calls the API with this session, logging in first if needed.
+
+        If the session expired (401), logs in again and retries once.
+
+        :param method: 'GET', 'POST'...
+        :param path: path after /api/, eg. 'dashboard/'
+        :param kwargs: passed to requests, eg. json={...}
+        :returns: the requests response, raises on error.
+        """
+        params = kwargs.pop('params', {})
+        for attempt in range(2):
+            if not getattr(self, 'session_id', None):
+                self.login()
+            params = dict(params, sessionId=self.session_id)
+            r = self.s.request(method, self.api + path, params=params, **kwargs)
+            if r.status_code == 401 and attempt == 0:
+                logging.info('Session expired, logging in again.')
+                del self.session_id
+                continue
+            r.raise_for_status()
+            return r
+
+
+class DundasPool:
+    """
+    Up to `size` logged in DundasSession, shared between threads. Sessions are only logged in when needed, kept
+    logged in to be reused, and all logged out on close().
+
+    As DundasSession, use it within a context manager to be sure to log out:
+
+        with DundasPool(user, pwd, url, size=4) as pool:
+            r = pool.request('GET', 'dashboard/...')
+            responses = pool.parallel([('GET', 'dashboard/' + i, {}) for i in ids])
+
+    From asyncio, run the calls in an executor: await loop.run_in_executor(None, pool.request, 'GET', path)
+    """
+    def __new__(cls, *args, **kwargs):
+        o=super().__new__(cls)
+        o.__init__(*args, **kwargs)
+        return contextlib.closing(o)
+
+    def __init__(self, user, pwd, url, size=4):
+        self.user = user
+        self.pwd = pwd
+        self.url = url
+        self.size = size
+
+        # Last used first, so that a few sessions are busy rather than all of them a bit.
+        self.idle = queue.LifoQueue()
+        # Sessions created so far, idle or not.
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def session(self):
+        """Context manager lending a DundasSession, waiting for one to be free if `size` are in use."""
+        try:
+            s = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                s = None
+                if len(self.sessions) < self.size:
+                    # DundasSession() is wrapped by closing(), its thing is the session itself.
+                    s = DundasSession(self.user, self.pwd, self.url).thing
+                    self.sessions.append(s)
+            if s is None:
+                s = self.idle.get()
+        try:
+            yield s
+        finally:
+            self.idle.put(s)
+
+    def request(self, method, path, **kwargs):
+        """DundasSession.request() with a session of the pool."""
+        with self.session() as s:
+            return s.request(method, path, **kwargs)
+
+    def parallel(self, calls, concurrency=None):
+        """
+        Runs many calls at the same time, at most `concurrency` (and no more than the pool size) at once.
+
+        :param calls: iterable of (method, path, kwargs) tuples.
+        :returns: list of responses, in the order of calls. Raises the first error met.
+        """
+        workers = min(concurrency or self.size, self.size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(lambda c: self.request(c[0], c[1], **c[2]), calls))
+
+    def close(self):
+        """Automagically called by the context manager. Logs out all sessions, even if some fail to."""
+        with self.lock:
+            sessions, self.sessions = self.sessions, []
+            self.idle = queue.LifoQueue()
+        for s in sessions:
+            try:
+                s.logout()
+            except Exception:
+                logging.exception('Could not log out a session.')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level='INFO')
 
-with DundasSession(user='yourapiuser', pwd='pwd', url='https://reports.example.com') as dundas:
-    dundas.login()
+    with DundasSession(user='yourapiuser', pwd='pwd', url='https://reports.example.com') as dundas:
+        dundas.login()
 
-    # Do something smart with your Dundas object.
+        # Do something smart with your Dundas object.
 
-# No need to log out, this is handled for you via the context manager, even in case of exception or even sys.exit.
+    # No need to log out, this is handled for you via the context manager, even in case of exception or even sys.exit.
@@ -3,11 +3,78 @@ import shlex
 import sublime
 import sublime_plugin
 import os
+import subprocess
+import tempfile
+import threading
+import time
+
+# Saves within this window are copied together.
+DEBOUNCE_MS = 500
+# How long the ssh connection stays open after the last copy.
+PERSIST = '10m'
+
+# vagrant dir -> set of saved file names, waiting to be copied.
+pending = {}
+# Incremented on every save, a flush only happens if no save happened since it was scheduled.
+generation = 0
+lock = threading.Lock()
+# vagrant dir -> ssh config file, as `vagrant ssh` takes seconds to start.
+ssh_configs = {}
+
+
+def ssh_config(vagrant_dir):
+    """Writes once the output of `vagrant ssh-config` for this vagrant dir, and returns the file name."""
+    if vagrant_dir not in ssh_configs:
+        config = subprocess.check_output(shlex.split('vagrant ssh-config'), cwd=vagrant_dir)
+        fd, path = tempfile.mkstemp(prefix='awesome_plugin_', suffix='.ssh_config')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(config)
+        ssh_configs[vagrant_dir] = path
+    return ssh_configs[vagrant_dir]
+
+
+def copy(vagrant_dir, savedfiles):
+    """
+    Copies all files in one command, over an ssh connection kept open (ControlMaster) between batches.
+    """
+    sources = ' '.join(shlex.quote('/vagrant/' + f) for f in sorted(savedfiles))
+    cmd_cp = 'sudo cp {0} /project/'.format(sources)
+
+    cmd = 'ssh -F {0} -o ControlMaster=auto -o ControlPath={1} -o ControlPersist={2} default'.format(
+        shlex.quote(ssh_config(vagrant_dir)),
+        shlex.quote(os.path.join(tempfile.gettempdir(), 'awesome_plugin_%C')),
+        PERSIST,
+    )
+    subprocess.check_output(shlex.split(cmd) + [cmd_cp], cwd=vagrant_dir, stderr=subprocess.STDOUT)
+
+
+def flush(scheduled):
+    with lock:
+        if scheduled != generation:
+            # Another save happened since, its own flush will take care of it.
+            return
+        batches = dict(pending)
+        pending.clear()
+
+    for vagrant_dir, savedfiles in batches.items():
+        start = time.time()
+        try:
+            copy(vagrant_dir, savedfiles)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('Could not copy {0}: {1} {2}'.format(
+                ', '.join(sorted(savedfiles)), e, getattr(e, 'output', b'').decode(errors='replace')))
+            ssh_configs.pop(vagrant_dir, None)
+            sublime.status_message('Could not copy {0} file(s), see console.'.format(len(savedfiles)))
+            continue
+        # write in sublime status buffer
+        sublime.status_message('Copied {0} file(s) in {1:.2f}s'.format(len(savedfiles), time.time() - start))
 
 
 class UpdateOnSave(sublime_plugin.EventListener):
 
     def on_post_save_async(self, view):
+        global generation
+
         filename = view.file_name()
         savedfile = os.path.basename(filename)
         saveddir = os.path.dirname(filename)
@@ -15,13 +82,9 @@ class UpdateOnSave(sublime_plugin.EventListener):
         # write in sublime status buffer
         sublime.status_message('Manually saving ' + filename)
 
-        source_in_vagrant = '/vagrant/' + savedfile
-        dest_in_vagrant = '/project/' + savedfile
-
-        cmd_cp = "vagrant ssh -c 'sudo cp {0} {1}'".format(source, dest)
+        with lock:
+            pending.setdefault(saveddir, set()).add(savedfile)
+            generation += 1
+            scheduled = generation
 
-        view.window().run_command('exec', {
-            'cmd': shlex.split(cmd_cp),
-            'working_dir': saveddir,
-        }
-        )
\ No newline at end of file
+        sublime.set_timeout_async(lambda: flush(scheduled), DEBOUNCE_MS)
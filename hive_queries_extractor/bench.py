@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks of hqe.
+
+classify: generates a synthetic HiveServer2 log in memory, and measures how many lines per second are reduced to
+events, with the former cascade of regex searches and strptime on every line (before) and the current single pass
+classifier (after). Both must produce exactly the same events.
+
+suite: runs hqe in its different parsing modes over logs generated by loggen.py, each in its own process, and
+reports lines/s, MB/s, peak memory and whether the extracted queries are exactly the expected ones.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import hqe
+import loggen
+
+
+def synthetic_log(nb_lines, seed=42):
+    """
+    Returns a list of log lines, most of them of no interest, as in real logs.
+
+    Kept simple and the same across versions, so that classify results can be compared.
+    """
+    rnd = random.Random(seed)
+    dt = datetime.datetime(2016, 1, 18, 0, 0, 0)
+    lines = []
+    qid = 0
+    while len(lines) < nb_lines:
+        dt += datetime.timedelta(milliseconds=rnd.randint(1, 200))
+        ts = dt.strftime('%Y-%m-%d %H:%M:%S') + ',{:03d} '.format(dt.microsecond // 1000)
+        tid = rnd.randint(1, 50)
+        r = rnd.random()
+        if r < 0.40:
+            lines.append(ts + 'INFO  [main]: metastore.HiveMetaStore (HiveMetaStore.java:logInfo(746)) - 3: get_table : db=default tbl=t{}\n'.format(tid))
+        elif r < 0.75:
+            lines.append(ts + 'INFO  [HiveServer2-Background-Pool: Thread-{}]: exec.Task (SessionState.java:printInfo(951)) - Stage-1 map = {}%,  reduce = 0%\n'.format(tid, rnd.randint(0, 100)))
+        elif r < 0.85:
+            lines.append(ts + 'INFO  [HiveServer2-Handler-Pool: Thread-{}]: thrift.ThriftCLIService (ThriftCLIService.java:OpenSession(294)) - Client protocol version: HIVE_CLI_SERVICE_PROTOCOL_V8\n'.format(tid))
+        elif r < 0.88:
+            qid += 1
+            lines.append(ts + 'INFO  [HiveServer2-Background-Pool: Thread-{}]: ql.Driver (Driver.java:execute(1390)) - Starting command(queryId=hive_{}_{}): select *\n'.format(tid, dt.strftime('%Y%m%d%H%M%S'), qid))
+            lines.append('from t{} where x > {}\n'.format(tid, qid))
+        elif r < 0.91:
+            lines.append(ts + 'INFO  [HiveServer2-Background-Pool: Thread-{}]: lockmgr.DbTxnManager (DbTxnManager.java:acquireLocks) - Setting lock request transaction to txnid:{}, user:etl, hostname:edge1, for lock\n'.format(tid, qid))
+        elif r < 0.94:
+            lines.append(ts + 'INFO  [HiveServer2-Background-Pool: Thread-{}]: log.PerfLogger (PerfLogger.java:PerfLogEnd(148)) - </PERFLOG method=Driver.run start=1 end=2 duration={} from=org.apache.hadoop.hive.ql.Driver>\n'.format(tid, rnd.randint(10, 99999)))
+        elif r < 0.95:
+            lines.append(ts + 'INFO  [HiveServer2-Handler-Pool: Thread-{}]: parse.ParseDriver (ParseDriver.java:parse(185)) - Parsing command: selec {}\n'.format(tid, qid))
+            lines.append(ts + 'ERROR [HiveServer2-Handler-Pool: Thread-{}]: ql.Driver (SessionState.java:printError(960)) - FAILED: ParseException line 1:0 cannot recognize input near selec\n'.format(tid))
+        else:
+            lines.append(ts + 'ERROR [HiveServer2-Background-Pool: Thread-{}]: exec.Task - java.lang.NullPointerException\n'.format(tid))
+            lines.append('\tat org.apache.hadoop.hive.ql.exec.Task.execute(Task.java:160)\n')
+    return lines
+
+
+# The cascade of searches hqe used to run on every line.
+re_dt = re.compile('^(?P<dt>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d{3} (?P<log>.*)$')
+
+
+def cascade_line_events(grep, lines, since, to):
+    """
+    Same as Grep.line_events, with the former classification: every pattern is searched in turn.
+    """
+    maybe_in_command = True
+    exists = {}
+    alive = {}
+
+    for l in lines:
+        dt_match = re.search(re_dt, l)
+        if not dt_match:
+            if maybe_in_command:
+                yield ('cont', l)
+            continue
+
+        dt = datetime.datetime.strptime(dt_match.group('dt'), '%Y-%m-%d %H:%M:%S')
+        if dt > to:
+            break
+        if dt < since:
+            continue
+        log = dt_match.group('log')
+
+        isbg = re.search(grep.re_bgpool, log)
+        if isbg:
+            tid = isbg.group('tid')
+            rest = isbg.group('rest')
+            was_in_command = maybe_in_command
+            maybe_in_command = False
+
+            kind = None
+            data = None
+            cmdstart = re.search(grep.re_cmdstart, rest)
+            if cmdstart:
+                kind = 'cmd'
+                data = (cmdstart.group('qid'), cmdstart.group('cmd'))
+                maybe_in_command = True
+            else:
+                meta = re.search(grep.re_meta, rest)
+                if meta:
+                    kind = 'meta'
+                    data = (meta.group('txnid'), meta.group('user'), meta.group('host'))
+                else:
+                    end = re.search(grep.re_endofthread, rest)
+                    if end:
+                        kind = 'end'
+                        data = end.group('duration')
+
+            known = exists.get(tid)
+            if kind is None and known and alive[tid] == dt_match.group('dt')[:16]:
+                if was_in_command:
+                    yield ('reset',)
+                continue
+            alive[tid] = dt_match.group('dt')[:16]
+
+            if kind == 'end':
+                exists[tid] = None if known is None else not known
+            else:
+                exists[tid] = True
+            yield ('bg', dt, tid, kind, data)
+            continue
+
+        is_handler = re.search(grep.re_handler, log)
+        if is_handler:
+            is_parsing = re.search(grep.re_parsing, is_handler.group('rest'))
+            if is_parsing:
+                maybe_in_command = True
+                yield ('hparse', dt, is_parsing.group('cmd'))
+                continue
+            is_handler_error = re.search(grep.re_handler_error, is_handler.group('rest'))
+            if is_handler_error:
+                maybe_in_command = False
+                yield ('herror', dt, is_handler_error.group('error'))
+                continue
+
+        if maybe_in_command:
+            maybe_in_command = False
+            yield ('reset',)
+
+
+def measure(name, func, lines, repeat):
+    """
+    Runs func over lines a few times, keeping the best time. Returns the events of the last run.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        events = list(func(lines))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('{name:>8}: {lps:>12,.0f} lines/s ({events} events)'.format(
+        name=name,
+        lps=len(lines) / best,
+        events=len(events)
+    ))
+    return events
+
+
+def classify(args):
+    grep = hqe.Grep(config())
+    lines = synthetic_log(args.lines)
+    since = datetime.datetime.min
+    to = datetime.datetime.max
+
+    # hqe reads bytes, it used to read text.
+    raw = [l.encode() for l in lines]
+
+    before = measure('before', lambda l: cascade_line_events(grep, l, since, to), lines, args.repeat)
+    after = measure('after', lambda l: grep.line_events(raw, since, to), lines, args.repeat)
+    if before != after:
+        raise(Exception('Classifiers do not agree on the events.'))
+
+
+def config(**options):
+    """
+    hqe configuration with its defaults, without parsing the command line.
+    """
+    c = types.SimpleNamespace(**{k: v for k, v in vars(hqe.Config).items() if not k.startswith('_')})
+    for k, v in options.items():
+        setattr(c, k, v)
+    return c
+
+
+def run(args):
+    """
+    Runs one mode in this process, and prints its measures as json.
+    """
+    c = config(logdir=args.logdir, jobs=args.jobs, index_dir=args.index_dir)
+    grep = hqe.Grep(c)
+    since = datetime.datetime.strptime(args.since, '%Y-%m-%d %H:%M:%S')
+    to = datetime.datetime.strptime(args.to, '%Y-%m-%d %H:%M:%S')
+
+    digest = loggen.Digest()
+    start = time.perf_counter()
+    for q in grep.extract_queries(grep.find_files_to_parse(since, to), since, to):
+        digest.add(loggen.query_key(q.start, q.user, q.host, q.duration, q.status, q.query, q.queryid))
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({
+        'seconds': elapsed,
+        'count': digest.count,
+        'sum': digest.sum,
+        # Kilobytes on Linux. Worker processes of --jobs are children.
+        'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'maxrss_children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }))
+
+
+def suite(args):
+    with open(os.path.join(args.logdir, 'expected.summary.json')) as f:
+        summary = json.load(f)
+    expected = loggen.Digest()
+    with open(os.path.join(args.logdir, 'expected.jsonl')) as f:
+        for l in f:
+            q = json.loads(l)
+            expected.add(loggen.query_key(**q))
+
+    index_dir = tempfile.mkdtemp(prefix='hqe-bench-')
+    modes = [
+        ('serial', ['--jobs', '1', '--index-dir', '']),
+        ('jobs={}'.format(args.jobs), ['--jobs', str(args.jobs), '--index-dir', '']),
+        ('index (cold)', ['--jobs', '1', '--index-dir', index_dir]),
+        ('index (warm)', ['--jobs', '1', '--index-dir', index_dir]),
+    ]
+
+    print('{} lines, {:.1f} MB, {} queries in {}'.format(
+        summary['lines'], summary['bytes'] / 2 ** 20, summary['queries'], ', '.join(summary['files'])))
+    print('{:>14} {:>9} {:>12} {:>8} {:>10} {:>8}'.format('mode', 'seconds', 'lines/s', 'MB/s', 'peak MB', 'correct'))
+    for name, options in modes:
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), 'run', args.logdir,
+             '--since', summary['since'], '--to', summary['to']] + options,
+            check=True, stdout=subprocess.PIPE
+        ).stdout
+        r = json.loads(out)
+        got = loggen.Digest()
+        got.count, got.sum = r['count'], r['sum']
+        print('{:>14} {:>9.2f} {:>12,.0f} {:>8.1f} {:>10.1f} {:>8}'.format(
+            name,
+            r['seconds'],
+            summary['lines'] / r['seconds'],
+            summary['bytes'] / 2 ** 20 / r['seconds'],
+            max(r['maxrss'], r['maxrss_children']) / 1024,
+            'yes' if got == expected else 'NO ({} queries)'.format(r['count'])
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks hqe.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('classify', help='Lines/s of the line classification, before and after.')
+    p.add_argument('--lines', dest='lines', type=int, default=500000, help='Number of log lines to generate.')
+    p.add_argument('--repeat', dest='repeat', type=int, default=3, help='Runs per classifier, best is kept.')
+    p.set_defaults(func=classify)
+
+    p = sub.add_parser('suite', help='Throughput, memory and correctness of each parsing mode.')
+    p.add_argument('logdir', type=str, help='Directory of logs generated by loggen.py.')
+    p.add_argument('--jobs', dest='jobs', type=int, default=4, help='Number of processes of the parallel mode.')
+    p.set_defaults(func=suite)
+
+    # Used by suite, to measure each mode in its own process.
+    p = sub.add_parser('run')
+    p.add_argument('logdir', type=str)
+    p.add_argument('--since', dest='since', type=str)
+    p.add_argument('--to', dest='to', type=str)
+    p.add_argument('--jobs', dest='jobs', type=int)
+    p.add_argument('--index-dir', dest='index_dir', type=str)
+    p.set_defaults(func=run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,16 +8,53 @@ Reads Hive log files, and extract all queries ran, with some info (user, duratio
 Assumptions:
 - files are rolled per day
 
+Can be used as a library, importing it has no side effects:
+    config = hqe.Config(['--logdir', '/var/log/hive', '--since', '1h'])
+    for q in hqe.Grep(config).get_queries():
+        ...
 """
 
 import argparse
+import array
+import atexit
+import bisect
+import bz2
 import collections
+import concurrent.futures
+import copy
+import cProfile
+import csv
 import datetime
+import functools
 import glob
-import gzip
+import hashlib
+import heapq
+import http.server
+import importlib.util
+import io
+import itertools
+import json
+import locale
 import logging
+import lzma
+import math
+import mmap
 import os
+import queue
 import re
+import socketserver
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    # Only needed to read .zst rolled files.
+    zstandard = None
 
 
 class Config():
@@ -25,13 +62,45 @@ class Config():
     loglevel = 'warn'
     logdir = '/var/log/hive'
     logfile_glob = 'hiveserver2.log*'
+    sources = None
 
     since = '15m'
     to = 'now'
 
-    def __init__(self):
+    jobs = 1
+
+    index_dir = os.path.expanduser('~/.cache/hqe')
+
+    follow = False
+    checkpoint = None
+    poll = 1.0
+
+    max_idle = '6h'
+
+    aggregate = False
+    top = 20
+
+    db = None
+    ingest = False
+
+    user = None
+    status = None
+    min_duration = None
+    query_regex = None
+    querytype = None
+
+    stats = False
+    profile = None
+
+    serve = None
+    buffer = 100000
+
+    format = 'text'
+    output = '-'
+
+    def __init__(self, args=None):
         """
-        Initialise the parser and do its magic.
+        Initialise the parser and do its magic, on args if given or on the command line.
         """
         parser = argparse.ArgumentParser(
             description='Displays queries ran on Hive.',
@@ -64,36 +133,1133 @@ class Config():
             help='Directory of hive log files.'
         )
 
-        parser.add_argument(
-            '--glob',
-            dest='logfile_glob',
-            action='store',
-            default=self.logfile_glob,
-            type=str,
-            help='Shell pattern of hive logfiles inside their logdir.'
-        )
+        parser.add_argument(
+            '--glob',
+            dest='logfile_glob',
+            action='store',
+            default=self.logfile_glob,
+            type=str,
+            help='Shell pattern of hive logfiles inside their logdir.'
+        )
+
+        parser.add_argument(
+            '--source',
+            dest='sources',
+            action='append',
+            default=self.sources,
+            type=str,
+            help='Log files of one HiveServer2 instance, as name=logdir or name=logdir:glob. Can be given for each '
+                 'instance, queries of all of them are then shown by start time, tagged with the instance name. '
+                 'Replaces --logdir and --glob. Not with --follow, --serve or --db.'
+        )
+
+        parser.add_argument(
+            '--jobs', '-j',
+            dest='jobs',
+            action='store',
+            default=self.jobs,
+            type=int,
+            help='Number of processes parsing files in parallel.'
+        )
+
+        parser.add_argument(
+            '--index-dir',
+            dest='index_dir',
+            action='store',
+            default=self.index_dir,
+            type=str,
+            help='Directory of the time to offset indexes of log files. Empty string to disable indexes.'
+        )
+
+        parser.add_argument(
+            '--follow', '-f',
+            dest='follow',
+            action='store_true',
+            default=self.follow,
+            help='Keep reading the current log file, following its rotations, and show queries as they end. '
+                 '--to is ignored.'
+        )
+
+        parser.add_argument(
+            '--checkpoint',
+            dest='checkpoint',
+            action='store',
+            default=self.checkpoint,
+            type=str,
+            help='With --follow, file where to save the position and the queries being parsed, to resume from '
+                 'there on restart. --since is ignored when resuming.'
+        )
+
+        parser.add_argument(
+            '--poll',
+            dest='poll',
+            action='store',
+            default=self.poll,
+            type=float,
+            help='With --follow, seconds to wait for new lines at the end of the log file.'
+        )
+
+        parser.add_argument(
+            '--max-idle',
+            dest='max_idle',
+            action='store',
+            default=self.max_idle,
+            type=str,
+            help='Forget about a query without log line for that long (eg. 30m, 6h, 1d), as it will never end. '
+                 'It is shown with an Unfinished status.'
+        )
+
+        parser.add_argument(
+            '--aggregate', '-a',
+            dest='aggregate',
+            action='store_true',
+            default=self.aggregate,
+            help='Instead of showing each query, show counts, durations and failure rates per query shape '
+                 '(query without literals), per user and per host, once all queries are read. Not with --follow.'
+        )
+
+        parser.add_argument(
+            '--top',
+            dest='top',
+            action='store',
+            default=self.top,
+            type=int,
+            help='With --aggregate, number of groups to show, with the highest total duration first.'
+        )
+
+        parser.add_argument(
+            '--db',
+            dest='db',
+            action='store',
+            default=self.db,
+            type=str,
+            help='SQLite database of queries. Without --ingest, queries are read from there instead of the logs.'
+        )
+
+        parser.add_argument(
+            '--ingest',
+            dest='ingest',
+            action='store_true',
+            default=self.ingest,
+            help='Parse the part of the log files not parsed yet, and store their queries in --db.'
+        )
+
+        parser.add_argument(
+            '--user',
+            dest='user',
+            action='store',
+            default=self.user,
+            type=str,
+            help='Only show queries of this user.'
+        )
+
+        parser.add_argument(
+            '--status',
+            dest='status',
+            action='store',
+            default=self.status,
+            type=str,
+            help='Only show queries with this status (FAILED, Probably success, Running, Unfinished).'
+        )
+
+        parser.add_argument(
+            '--min-duration',
+            dest='min_duration',
+            action='store',
+            default=self.min_duration,
+            type=float,
+            help='Only show queries which ran for at least that many seconds.'
+        )
+
+        parser.add_argument(
+            '--query-regex',
+            dest='query_regex',
+            action='store',
+            default=self.query_regex,
+            type=str,
+            help='Only show queries matching this regular expression.'
+        )
+
+        parser.add_argument(
+            '--type',
+            dest='querytype',
+            action='store',
+            default=self.querytype,
+            type=str.lower,
+            help='Only show queries of this type (first word of the query, eg. select, insert).'
+        )
+
+        parser.add_argument(
+            '--loglevel', '-l',
+            dest='loglevel',
+            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+            type=str.upper,
+            default=self.loglevel,
+            help='Log level.'
+        )
+
+        parser.add_argument(
+            '--stats',
+            dest='stats',
+            action='store_true',
+            default=self.stats,
+            help='At the end, show on stderr what was read and matched per file, and where the time went.'
+        )
+
+        parser.add_argument(
+            '--profile',
+            dest='profile',
+            action='store',
+            default=self.profile,
+            type=str,
+            help='Write a cProfile profile of the run to this file (worker processes of --jobs are not profiled).'
+        )
+
+        parser.add_argument(
+            '--serve',
+            dest='serve',
+            action='store',
+            default=self.serve,
+            type=str,
+            help='Follow the logs, keeping the last queries in memory, and answer lookups over HTTP on this address: '
+                 'host:port, or unix:path for a Unix socket.'
+        )
+
+        parser.add_argument(
+            '--buffer',
+            dest='buffer',
+            action='store',
+            default=self.buffer,
+            type=int,
+            help='With --serve, number of queries kept in memory.'
+        )
+
+        parser.add_argument(
+            '--format',
+            dest='format',
+            choices=sorted(WRITERS),
+            default=self.format,
+            type=str.lower,
+            help='Output format. columnar is parquet if pyarrow is available, npz (numpy) otherwise.'
+        )
+
+        parser.add_argument(
+            '--output', '-o',
+            dest='output',
+            action='store',
+            default=self.output,
+            type=str,
+            help='File to write queries (or the --aggregate report) to, - for stdout.'
+        )
+
+        parser.parse_args(args, namespace=self)
+
+        if self.follow and issubclass(WRITERS[self.format], ColumnarWriter):
+            # They are only complete once closed, which never happens when following.
+            parser.error('--format {} cannot be used with --follow.'.format(self.format))
+        if self.sources:
+            # Only reading a time range merges sources; following, serving and the database use --logdir.
+            for option, given in (('--follow', self.follow), ('--serve', self.serve), ('--db', self.db)):
+                if given:
+                    parser.error('--source cannot be used with {}.'.format(option))
+        if self.aggregate and self.follow:
+            # The report is only shown at the end, which never comes when following.
+            parser.error('--aggregate cannot be used with --follow.')
+        if self.aggregate and self.format != 'text':
+            parser.error('--format {} cannot be used with --aggregate, its report is text.'.format(self.format))
+
+
+def query_type(query):
+    """
+    First word of a query text, whatever whitespace follows it (formatted queries often go to the next line).
+    """
+    words = query.split(None, 1)
+    return words[0] if words else ''
+
+
+class QueryFilter():
+    """
+    Criteria queries must meet to be shown.
+
+    They are checked while parsing as soon as what they are about is known, so that a query ruled out is neither
+    kept in the parsing state nor built.
+    """
+
+    # Background-Pool queries never have another status. Handler-Pool ones are always FAILED.
+    thread_statuses = ('Probably success', 'Running', 'Unfinished')
+
+    def __init__(self, user=None, status=None, min_duration=None, query_regex=None, querytype=None):
+        self.user = user
+        self.status = status
+        self.min_duration = min_duration
+        self.query_regex = re.compile(query_regex) if query_regex else None
+        self.querytype = querytype.lower() if querytype else None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            user=config.user,
+            status=config.status,
+            min_duration=config.min_duration,
+            query_regex=config.query_regex,
+            querytype=config.querytype
+        )
+
+    def rejects_thread(self, handler):
+        """
+        Whether a query can be ruled out from the first line of its thread.
+        """
+        if self.status is not None and (self.status != 'FAILED' if handler else self.status not in self.thread_statuses):
+            return True
+        # Handler-Pool queries have no user and no duration.
+        return handler and (self.user not in (None, 'Unknown') or self.min_duration is not None)
+
+    def rejects_user(self, user):
+        return self.user is not None and user != self.user
+
+    def rejects_command(self, cmd):
+        """
+        Whether a query can be ruled out from the first line of its command. Blank, it does not tell the type yet.
+        """
+        if self.querytype is None:
+            return False
+        first = query_type(cmd)
+        return first != '' and first.lower() != self.querytype
+
+    def matches(self, q):
+        """
+        Whether a Query object meets all the criteria.
+        """
+        return (
+            (self.status is None or q.status == self.status) and
+            (self.user is None or q.user == self.user) and
+            (self.min_duration is None or (q.duration is not None and q.duration >= self.min_duration)) and
+            (self.querytype is None or q.querytype.lower() == self.querytype) and
+            (self.query_regex is None or self.query_regex.search(q.query) is not None)
+        )
+
+    def accepts(self, d):
+        """
+        Whether a query, fully parsed as a hash, meets all the criteria.
+        """
+        if self.status is not None and d.get('status', 'Unknown') != self.status:
+            return False
+        if self.user is not None and d.get('user', 'Unknown') != self.user:
+            return False
+        if self.min_duration is not None and ('duration' not in d or int(d['duration']) / 1000 < self.min_duration):
+            return False
+        if self.querytype is not None and query_type(''.join(d['query'])).lower() != self.querytype:
+            return False
+        if self.query_regex is not None and not self.query_regex.search(''.join(d['query'])):
+            return False
+        return True
+
+
+# Timestamps of the logs are naive UTC datetimes (see Grep.parse_ts).
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class Query():
+    """
+    A query extracted from the logs.
+
+    Millions of them can be extracted, hence slots and numbers: start is an epoch timestamp and duration is in
+    seconds, None if unknown.
+    """
+
+    __slots__ = ('start', 'user', 'host', 'duration', 'querytype', 'query', 'threadid', 'queryid', 'txnid', 'status', 'error', 'server')
+
+    def __init__(self, start, user, host, duration, querytype, query, threadid, queryid, txnid, status, error, server=None):
+        self.start = start
+        self.user = user
+        self.host = host
+        self.duration = duration
+        self.querytype = querytype
+        self.query = query
+        self.threadid = threadid
+        self.queryid = queryid
+        self.txnid = txnid
+        self.status = status
+        self.error = error
+        # Name of the HiveServer2 instance, see Config.sources
+        self.server = server
+
+    def __repr__(self):
+        return 'Query({})'.format(', '.join('{}={!r}'.format(f, getattr(self, f)) for f in self.__slots__))
+
+    def __eq__(self, other):
+        return isinstance(other, Query) and all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    def start_datetime(self):
+        return EPOCH + datetime.timedelta(seconds=self.start)
+
+    def to_dict(self):
+        """
+        Fields of the query, json serialisable. start is kept as epoch, start_time is readable.
+        """
+        d = {f: getattr(self, f) for f in self.__slots__}
+        d['start_time'] = self.start_datetime().isoformat(' ')
+        return d
+
+
+class QueryBatch():
+    """
+    Columnar storage of queries, for analysis without the overhead of one object per query.
+
+    Numbers are stored in arrays of doubles (unknown durations are NaN), strings in lists, where repeated values
+    are the same object when they come from Grep.
+    """
+
+    def __init__(self):
+        self.start = array.array('d')
+        self.duration = array.array('d')
+        self.columns = {f: [] for f in Query.__slots__ if f not in ('start', 'duration')}
+
+    def __len__(self):
+        return len(self.start)
+
+    def __getattr__(self, name):
+        # String columns, eg. batch.user
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise(AttributeError(name))
+
+    def append(self, q):
+        self.start.append(q.start)
+        self.duration.append(float('nan') if q.duration is None else q.duration)
+        for f, column in self.columns.items():
+            column.append(getattr(q, f))
+
+    def __iter__(self):
+        """
+        Generates back the Query objects.
+        """
+        for i in range(len(self)):
+            duration = self.duration[i]
+            yield Query(
+                start=self.start[i],
+                duration=None if duration != duration else duration,
+                **{f: column[i] for f, column in self.columns.items()}
+            )
+
+    @classmethod
+    def batches(cls, queries, size=65536):
+        """
+        Groups a stream of queries in batches of at most size queries.
+        """
+        batch = cls()
+        for q in queries:
+            batch.append(q)
+            if len(batch) >= size:
+                yield batch
+                batch = cls()
+        if len(batch):
+            yield batch
+
+
+# Normalisation of queries into fingerprints.
+# Strings and comments in one pass, so that -- within a string is not a comment, and quotes in a comment no string.
+re_string_or_comment = re.compile(r"""(?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|--[^\n]*""")
+re_number = re.compile(r'(?<![\w.])[-+]?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?(?![\w.])')
+re_in_list = re.compile(r'\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+re_spaces = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=65536)
+def fingerprint(query):
+    """
+    Shape of a query: lowercase, without literals, comments and extra whitespace, IN lists reduced to one item.
+
+    Cached, as the same queries are run again and again.
+    """
+    fp = re_string_or_comment.sub(lambda m: '?' if m.group('string') else ' ', query)
+    fp = re_number.sub('?', fp)
+    fp = re_in_list.sub('in (?)', fp)
+    fp = re_spaces.sub(' ', fp)
+    return fp.strip().lower()
+
+
+class DurationHistogram():
+    """
+    Approximate distribution of durations, in constant memory.
+
+    Durations are counted in logarithmic buckets, each one 2% wider than the previous, so percentiles are known
+    with a relative error of about 1% whatever the number of durations.
+    """
+
+    ratio = math.log(1.02)
+    # Durations are never below the millisecond.
+    smallest = 0.001
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+
+    def add(self, duration):
+        self.buckets[int(math.log(max(duration, self.smallest) / self.smallest) / self.ratio)] += 1
+        self.count += 1
+
+    def percentile(self, p):
+        """
+        Approximate duration below which p percents of the durations are, None if there are no durations.
+        """
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # Middle of the bucket
+                return self.smallest * math.exp((bucket + 0.5) * self.ratio)
+
+
+class GroupStats():
+    """
+    Running statistics about a group of queries.
+    """
+
+    __slots__ = ('count', 'failed', 'total', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        self.total = 0.0
+        self.histogram = DurationHistogram()
+
+    def add(self, q):
+        self.count += 1
+        if q.status == 'FAILED':
+            self.failed += 1
+        if q.duration is not None:
+            self.total += q.duration
+            self.histogram.add(q.duration)
+
+
+class Aggregator():
+    """
+    Aggregates a stream of queries per fingerprint, user and host.
+    """
+
+    def __init__(self):
+        self.groups = {
+            'fingerprint': collections.defaultdict(GroupStats),
+            'user': collections.defaultdict(GroupStats),
+            'host': collections.defaultdict(GroupStats),
+        }
+
+    def add(self, q):
+        self.groups['fingerprint'][fingerprint(q.query)].add(q)
+        self.groups['user'][q.user].add(q)
+        self.groups['host'][q.host].add(q)
+
+    def report(self, top):
+        """
+        Text report of the top groups of each kind, by total duration.
+        """
+        lines = []
+        for name, groups in self.groups.items():
+            lines.append('== Per {} ({} groups) =='.format(name, len(groups)))
+            lines.append('{:>8} {:>7} {:>12} {:>10} {:>10} {:>10}  {}'.format(
+                'count', 'failed', 'total (s)', 'p50 (s)', 'p95 (s)', 'p99 (s)', name))
+            for key, stats in sorted(groups.items(), key=lambda g: (-g[1].total, -g[1].count))[:top]:
+                lines.append('{:>8} {:>6.1%} {:>12.3f} {:>10} {:>10} {:>10}  {}'.format(
+                    stats.count,
+                    stats.failed / stats.count,
+                    stats.total,
+                    *['-' if d is None else '{:.3f}'.format(d) for d in map(stats.histogram.percentile, (50, 95, 99))],
+                    key
+                ))
+            lines.append('')
+        return '\n'.join(lines)
+
+
+class Stats():
+    """
+    Counters and timings of a run, shown with --stats.
+
+    Counters of the line classification are always kept by Grep.line_events, as plain local integers: only putting
+    them here and timing the stages costs anything, and is only done when stats are wanted.
+    """
+
+    # Counters of each file, in the order they are shown.
+    counters = (
+        'bytes_read', 'bytes_decompressed', 'lines', 'lines_skipped',
+        're_bgpool', 're_cmdstart', 're_meta', 're_endofthread', 're_handler', 're_parsing', 're_handler_error',
+        'seconds'
+    )
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.files = collections.OrderedDict()
+        # Time spent in each stage, excluding the stages nested in it.
+        self.seconds = collections.Counter()
+        # Time the main thread spent waiting for the threads of --source, which time their own stages concurrently.
+        self.waits = collections.Counter()
+        # Largest number of queries being parsed at once, per source (None without --source).
+        self.peak_parsing = collections.Counter()
+        self.queries = 0
+        # Time spent in nested stages, per thread as sources are parsed in threads.
+        self.local = threading.local()
+
+    def file(self, file):
+        """
+        Counters of a file, to be updated.
+        """
+        return self.files.setdefault(file, collections.Counter())
+
+    def timed(self, iterable, stage, into=None):
+        """
+        Generates the items of iterable, adding the time spent producing them to a stage (to into[stage] if given).
+
+        The time spent in timed iterables consumed by this one is not counted, it is in their own stages.
+        """
+        into = self.seconds if into is None else into
+        it = iter(iterable)
+        clock = time.perf_counter
+        while True:
+            outer = getattr(self.local, 'nested', 0.0)
+            self.local.nested = 0.0
+            start = clock()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                elapsed = clock() - start
+                into[stage] += elapsed - self.local.nested
+                self.local.nested = outer + elapsed
+            yield item
+
+    def counted(self, queries):
+        for q in queries:
+            self.queries += 1
+            yield q
+
+    def report(self):
+        """
+        Text report per file and in total.
+        """
+        lines = []
+        if self.files:
+            total = collections.Counter()
+            lines.append(''.join('{:>14}'.format(re.sub('^(re|bytes|lines)_', '', c)) for c in self.counters) + '  file')
+            for file, counts in self.files.items():
+                total.update(counts)
+                lines.append(self.format_counts(counts) + '  ' + file)
+            lines.append(self.format_counts(total) + '  total')
+            lines.append('')
+
+        wall = time.perf_counter() - self.start
+        if list(self.peak_parsing) == [None]:
+            peaks = self.peak_parsing[None]
+        else:
+            peaks = ', '.join('{} {}'.format(s, n) for s, n in sorted(self.peak_parsing.items())) or 0
+        lines.append('peak parsing size: {}, queries emitted: {}'.format(peaks, self.queries))
+        for stage, seconds in sorted(self.seconds.items()):
+            lines.append('{:>10.3f}s  {}'.format(seconds, stage))
+        if self.waits:
+            # Stages above overlap, in the threads of the sources. The main thread only waited for them.
+            for stage, seconds in sorted(self.waits.items()):
+                lines.append('{:>10.3f}s  {} (overlaps the stages above)'.format(seconds, stage))
+            main = sum(self.waits.values())
+        else:
+            main = sum(self.seconds.values())
+        lines.append('{:>10.3f}s  output and the rest'.format(wall - main))
+        lines.append('{:>10.3f}s  wall time'.format(wall))
+        return '\n'.join(lines)
+
+    def format_counts(self, counts):
+        return ''.join(
+            '{:>14.3f}'.format(counts[c]) if c == 'seconds' else '{:>14}'.format(counts[c]) for c in self.counters
+        )
+
+
+class ParseState():
+    """
+    What is known about queries being parsed, carried from one line to the next and from one file to the next.
+    """
+
+    def __init__(self):
+        # Multiple queries can run in parallel, with log line intertwined, so we keep a hash of queries we know of.
+        # One a query is fully parsed, its entry is deleted from the hash, so it should never become too big.
+        self.parsing = {}
+
+        # When getting parsing error, here is no good id to extract from the log. Generate it here.
+        self.handler_id = 0
+
+        # A command is special beast as it is a multi line log message, without the Ts and other metadata.
+        # If a command is started, this variable will be set to the thread id.
+        self.in_command = None
+
+        # Log time at which to look for idle queries in parsing.
+        self.next_eviction = datetime.datetime.min
+
+        # Timestamp of the last event.
+        self.clock = datetime.datetime.min
+
+    def to_dict(self):
+        """
+        Json serialisable version of the state, for checkpoints.
+        """
+        parsing = {}
+        for tid, d in self.parsing.items():
+            parsing[tid] = dict(d, start=d['start'].isoformat(), last=d['last'].isoformat())
+        return {
+            'parsing': parsing,
+            'handler_id': self.handler_id,
+            'in_command': self.in_command,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Rebuilds a state saved with to_dict.
+        """
+        state = cls()
+        for tid, p in d['parsing'].items():
+            state.parsing[tid] = dict(
+                p,
+                start=datetime.datetime.fromisoformat(p['start']),
+                last=datetime.datetime.fromisoformat(p['last'])
+            )
+        state.handler_id = d['handler_id']
+        state.in_command = d['in_command']
+        return state
+
+
+class Tail():
+    """
+    Follows a log file through its rotations, keeping track of the position reached.
+
+    When the file is rotated (renamed, and a new one created in its place), the old one is read until its end
+    before moving to the new one. A truncated file is read again from its start.
+    """
+
+    def __init__(self, path, poll):
+        self.path = path
+        self.poll = poll
+
+        # What is currently read. It might not be path anymore if the file has been rotated.
+        self.f = None
+        self.identity = None
+        self.offset = 0
+
+    @staticmethod
+    def stat_identity(st):
+        return [st.st_dev, st.st_ino]
+
+    def open(self, path, offset=0):
+        """
+        Starts reading a file from offset.
+        """
+        if self.f:
+            self.f.close()
+        self.f = open(path, 'rb')
+        self.f.seek(offset)
+        self.identity = self.stat_identity(os.fstat(self.f.fileno()))
+        self.offset = offset
+
+    def rotated(self):
+        """
+        Whether path is not the file being read anymore.
+        """
+        try:
+            return self.stat_identity(os.stat(self.path)) != self.identity
+        except FileNotFoundError:
+            # In the middle of a rotation, the new file is not created yet.
+            return False
+
+    def lines(self, on_idle, every=10):
+        """
+        Generates complete lines, as bytes, forever.
+
+        When the consumer asks for a line, it is done with all the previous ones: on_idle is called at this point,
+        when waiting for new lines and at least every `every` seconds, to save the position.
+        """
+        last_call = time.monotonic()
+        while True:
+            if time.monotonic() - last_call > every:
+                on_idle()
+                last_call = time.monotonic()
+
+            l = self.f.readline()
+            if l.endswith(b'\n'):
+                self.offset += len(l)
+                yield l
+                continue
+
+            # End of file, maybe in the middle of a line being written.
+            self.f.seek(self.offset)
+
+            if os.fstat(self.f.fileno()).st_size < self.offset:
+                logging.warning("{} has been truncated, reading it again.".format(self.path))
+                self.open(self.path)
+                continue
+
+            if self.rotated():
+                # Nothing is written to the old file anymore, read what is left of it.
+                rest = self.f.read()
+                for l in rest.splitlines(keepends=True):
+                    self.offset += len(l)
+                    yield l
+                logging.info("{} has been rotated, following the new file.".format(self.path))
+                self.open(self.path)
+                continue
+
+            on_idle()
+            last_call = time.monotonic()
+            time.sleep(self.poll)
+
+
+class LogReader():
+    """
+    Lines of a log file, as bytes, from an offset in its uncompressed content. Rolled files might be compressed.
+
+    Plain files are memory mapped. Compressed files are read in a background thread and decompressed in another
+    one, so that I/O, decompression and parsing overlap: zlib, bz2 and lzma do not hold the GIL while working.
+    """
+
+    # Compressed files, by suffix, and how to decompress them.
+    codecs = {
+        '.gz': lambda: zlib.decompressobj(zlib.MAX_WBITS | 16),
+        '.bz2': bz2.BZ2Decompressor,
+        '.xz': lzma.LZMADecompressor,
+        '.zst': lambda: zstandard.ZstdDecompressor().decompressobj(),
+    }
+
+    # Bytes of compressed file read at once, and number of chunks read or decompressed ahead.
+    chunk_size = 262144
+    ahead = 4
+
+    def __init__(self, file, offset=0):
+        self.file = file
+        self.offset = offset
+        self.codec = self.codecs.get(os.path.splitext(file)[1])
+        if file.endswith('.zst') and zstandard is None:
+            raise(Exception('Reading {} needs the zstandard module.'.format(file)))
+
+        self.f = open(file, 'rb')
+        self.mmap = None
+        self.lines = None
+        # Up to date while compressed files are read, see bytes_read for plain files.
+        self.read = 0
+        self.decompressed = 0
+
+    @classmethod
+    def compressed(cls, file):
+        return os.path.splitext(file)[1] in cls.codecs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.lines is not None:
+            # Stops the background threads.
+            self.lines.close()
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.f.close()
+
+    def __iter__(self):
+        self.lines = self.plain_lines() if self.codec is None else self.compressed_lines()
+        return self.lines
+
+    @property
+    def bytes_read(self):
+        """
+        Bytes read from the file so far, read ahead included.
+        """
+        if self.codec is None:
+            return self.mmap.tell() - self.offset if self.mmap is not None else 0
+        return self.read
+
+    @property
+    def bytes_decompressed(self):
+        """
+        Bytes of uncompressed content read so far, those before offset included.
+        """
+        return self.bytes_read if self.codec is None else self.decompressed
+
+    def plain_lines(self):
+        if os.fstat(self.f.fileno()).st_size <= self.offset:
+            # Nothing to read, and empty files cannot be mapped.
+            return
+        self.mmap = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mmap.seek(self.offset)
+        yield from iter(self.mmap.readline, b'')
+
+    def raw_chunks(self):
+        for chunk in iter(functools.partial(self.f.read, self.chunk_size), b''):
+            self.read += len(chunk)
+            yield chunk
+
+    def decompressed_chunks(self, chunks):
+        d = self.codec()
+        for chunk in chunks:
+            while chunk:
+                data = d.decompress(chunk)
+                self.decompressed += len(data)
+                yield data
+                chunk = b''
+                if getattr(d, 'eof', False):
+                    # Concatenated streams (eg. gzip members) each need their own decompressor.
+                    chunk = d.unused_data
+                    d = self.codec()
+
+    def compressed_lines(self):
+        chunks = in_background(self.decompressed_chunks(in_background(self.raw_chunks(), self.ahead)), self.ahead)
+        skip = self.offset
+        rest = b''
+        try:
+            for data in chunks:
+                if skip:
+                    # Offsets are on line boundaries.
+                    if len(data) <= skip:
+                        skip -= len(data)
+                        continue
+                    data = data[skip:]
+                    skip = 0
+                data = rest + data
+                end = data.rfind(b'\n') + 1
+                rest = data[end:]
+                yield from io.BytesIO(data[:end])
+            if rest:
+                yield rest
+        finally:
+            chunks.close()
+
+
+class LogIndex():
+    """
+    Sidecar index of a log file, mapping each minute to the byte offset of its first line.
+
+    Offsets are in the uncompressed content of the file. The index is stored as json in its own directory, built
+    on first use and then extended when the file grows. Replaced, truncated or modified rolled files are indexed
+    again from scratch.
+    """
+
+    version = 2
+
+    # Timestamped lines start with 'yyyy-mm-dd hh:mm:ss'
+    re_ts = re.compile(rb'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
+
+    # Bytes at the start of a plain file which tell it apart from another one with the same inode.
+    identity_size = 4096
+
+    def __init__(self, file, index_dir):
+        self.file = file
+        self.path = os.path.join(
+            index_dir,
+            hashlib.sha1(os.path.abspath(file).encode()).hexdigest() + '.json'
+        )
+        self.compressed = LogReader.compressed(file)
+
+        # Sorted minutes ('yyyy-mm-dd hh:mm') and the offset of the first line of each.
+        self.minutes = []
+        self.offsets = []
+        # Number of bytes of the file already indexed, always on a line boundary.
+        self.indexed = 0
+        self.identity = None
+
+    def file_identity(self):
+        """
+        What must not change for the index to still be valid.
+
+        Plain files can only grow (the current log file), compressed ones must stay exactly the same. A plain file
+        rewritten in place (copytruncate) or a new one reusing the inode has another beginning.
+        """
+        st = os.stat(self.file)
+        if self.compressed:
+            return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+        with open(self.file, 'rb') as f:
+            head = f.read(self.identity_size)
+        return [st.st_dev, st.st_ino, hashlib.sha1(head).hexdigest()]
+
+    def still_indexed(self):
+        """
+        Whether the line at the offset of the last indexed minute is still of this minute.
+        """
+        if self.compressed or not self.minutes:
+            return True
+        with open(self.file, 'rb') as f:
+            f.seek(self.offsets[-1])
+            return f.read(16) == self.minutes[-1].encode()
+
+    def load(self):
+        """
+        Reads the index from disk, if any. Returns whether it could be used.
+        """
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if stored.get('version') != self.version or stored.get('file') != os.path.abspath(self.file):
+            return False
+
+        self.identity = stored['identity']
+        self.indexed = stored['indexed']
+        self.minutes = [m for m, _ in stored['minutes']]
+        self.offsets = [o for _, o in stored['minutes']]
+        return True
+
+    def save(self):
+        """
+        Atomically writes the index to disk.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'version': self.version,
+                'file': os.path.abspath(self.file),
+                'identity': self.identity,
+                'indexed': self.indexed,
+                'minutes': list(zip(self.minutes, self.offsets)),
+            }, f)
+        os.replace(tmp, self.path)
+
+    def update(self):
+        """
+        Makes sure the index covers the whole file, only reading what was not indexed yet.
+        """
+        identity = self.file_identity()
+        if not self.load() or self.identity != identity or (
+                not self.compressed and os.path.getsize(self.file) < self.indexed) or not self.still_indexed():
+            logging.debug("Indexing {} from scratch.".format(self.file))
+            self.minutes = []
+            self.offsets = []
+            self.indexed = 0
+        self.identity = identity
+
+        if not self.compressed and os.path.getsize(self.file) == self.indexed:
+            return
+
+        with LogReader(self.file, self.indexed) as f:
+            offset = self.indexed
+            last = self.minutes[-1].encode() if self.minutes else b''
+            for l in f:
+                if not l.endswith(b'\n'):
+                    # Line still being written, will be indexed next time.
+                    break
+                # Keeps the first offset of each new highest minute, so that everything before the offset of a
+                # minute is sure to be older, even if a few lines are not in order.
+                if l[:16] > last and self.re_ts.match(l):
+                    last = l[:16]
+                    self.minutes.append(last.decode())
+                    self.offsets.append(offset)
+                offset += len(l)
+        self.indexed = offset
+        self.save()
+
+    def offset(self, minute):
+        """
+        Offset from where all lines are at least at minute.
+        """
+        i = bisect.bisect_left(self.minutes, minute)
+        return self.offsets[i] if i < len(self.offsets) else self.indexed
+
+    def covers(self, since_minute, to_minute):
+        """
+        Whether the file might have lines between two minutes.
+        """
+        if not self.minutes:
+            # Nothing known, maybe not even timestamped lines.
+            return True
+        return self.minutes[0] <= to_minute and self.minutes[-1] >= since_minute
+
+
+class Timestamps():
+    """
+    Decodes the fixed format timestamps of HiveServer2 logs: 'yyyy-mm-dd hh:mm:ss'.
+
+    Many lines share the same second, so the last decoded timestamp is kept and given back as long as it does not
+    change. The timestamps themselves are sortable strings: comparing them to keys (see key) of since and to does not
+    need decoding at all.
+    """
+
+    def __init__(self):
+        self.last = None
+        self.dt = None
 
-        parser.add_argument(
-            '--loglevel', '-l',
-            dest='loglevel',
-            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
-            type=str.upper,
-            default=self.loglevel,
-            help='Log level.'
-        )
+    @staticmethod
+    def key(dt):
+        """
+        Sortable string of a datetime, comparable to the timestamps of the logs.
+        """
+        return '{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}'.format(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
 
-        parser.parse_args(namespace=self)
-        logging.basicConfig(level=self.loglevel)
+    def decode(self, ts):
+        """
+        Datetime of a log timestamp.
+        """
+        if ts != self.last:
+            self.dt = datetime.datetime(
+                int(ts[0:4]), int(ts[5:7]), int(ts[8:10]),
+                int(ts[11:13]), int(ts[14:16]), int(ts[17:19])
+            )
+            self.last = ts
+        return self.dt
 
 
 class Grep():
 
+    # pattern that will be look for.
+    # Most lines are of no interest: patterns are only tried if their literal part (the string next to them) is
+    # found in the line, which is much cheaper than a failed regex search.
+    re_dt = re.compile('(?P<dt>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d{3} ')
+
+    # Happy flow
+    re_bgpool = re.compile('HiveServer2-Background-Pool: Thread-(?P<tid>\d+)\]: (?P<rest>.*)$')
+    lit_bgpool = 'Background-Pool: Thread-'
+    re_endofthread = re.compile('</PERFLOG method=Driver.run .* duration=(?P<duration>\d+) from=org.apache.hadoop.hive.ql.Driver>')
+    lit_endofthread = 'PERFLOG method=Driver.run '
+    re_cmdstart = re.compile('Starting command\(queryId=(?P<qid>\S*)\): (?P<cmd>.*)$')
+    lit_cmdstart = 'Starting command('
+    re_meta = re.compile('txnid:(?P<txnid>\S*), user:(?P<user>\S*), hostname:(?P<host>\S*),')
+    lit_meta = 'txnid:'
+
+    # Error flow
+    re_handler = re.compile('\[HiveServer2-Handler-Pool.*?\]: (?P<rest>.*)')
+    lit_handler = 'Handler-Pool'
+    re_parsing = re.compile('Parsing command: (?P<cmd>.*)')
+    lit_parsing = 'Parsing command: '
+    re_handler_error = re.compile('FAILED: (?P<error>.*)')
+    lit_handler_error = 'FAILED: '
+
+    # Above this number of distinct query texts, forget about them to deduplicate the next ones.
+    max_texts = 100000
+
     def __init__(self, config):
         self.config = config
+        self.max_idle = self.parse_delta(config.max_idle)
+        self.filter = QueryFilter.from_config(config)
+        self.encoding = locale.getpreferredencoding(False)
+        # Same query texts are stored only once.
+        self.texts = {}
+        # Stats object, if they are wanted.
+        self.stats = None
+        # Name of the source, with --source.
+        self.source = None
+
+    def __getstate__(self):
+        # Worker processes of --jobs get a copy of this object, they give their stats back with their events.
+        # They only scan files, deduplicating query texts is done by the parent.
+        state = self.__dict__.copy()
+        state['stats'] = None
+        state['texts'] = {}
+        return state
 
-    def get_queries(self):
+    def get_queries(self, ordered=False):
         """
-        Return all hive queries ran in Hive between since and to.
+        Generates all hive queries ran in Hive between since and to, as they end or ordered by start time.
         """
         since = self.parse_ts(self.config.since, 'since')
         to = self.parse_ts(self.config.to, 'to')
@@ -105,7 +1271,10 @@ class Grep():
 
         f = self.find_files_to_parse(since, to)
         logging.info("Looking at files: {}".format(list(map(os.path.basename, f))))
-        return self.extract_queries(f, since, to)
+        if ordered:
+            yield from self.ordered_queries(f, since, to)
+        else:
+            yield from self.extract_queries(f, since, to)
 
     def parse_ts(self, ts, direction='since'):
         """
@@ -149,19 +1318,87 @@ class Grep():
 
         is_timedelta = re.search('(?P<delta>\d+)(?P<inc>[mhd])', ts)
         if is_timedelta:
-            if is_timedelta.group('inc') == 'm':
-                r = datetime.datetime.utcnow() - datetime.timedelta(minutes=int(is_timedelta.group('delta')))
-            elif is_timedelta.group('inc') == 'h':
-                r = datetime.datetime.utcnow() - datetime.timedelta(hours=int(is_timedelta.group('delta')))
-            elif is_timedelta.group('inc') == 'd':
-                r = datetime.datetime.utcnow() - datetime.timedelta(days=int(is_timedelta.group('delta')))
-            else:
-                raise(Exception('timedelta not understood: "{}"'.format(ts)))
+            r = datetime.datetime.utcnow() - self.parse_delta(ts)
             logging.debug(logstr.format(ts=ts, dt=r))
             return r
 
         raise(Exception("Timestamp not recognised: '{}'".format(ts)))
 
+    def parse_delta(self, delta):
+        """
+        Returns timedelta from a human readable duration: \d+[mhd] (eg 15m, 2h...)
+        """
+        is_timedelta = re.search('(?P<delta>\d+)(?P<inc>[mhd])', delta)
+        if not is_timedelta:
+            raise(Exception('timedelta not understood: "{}"'.format(delta)))
+        if is_timedelta.group('inc') == 'm':
+            return datetime.timedelta(minutes=int(is_timedelta.group('delta')))
+        elif is_timedelta.group('inc') == 'h':
+            return datetime.timedelta(hours=int(is_timedelta.group('delta')))
+        else:
+            return datetime.timedelta(days=int(is_timedelta.group('delta')))
+
+    def follow_queries(self):
+        """
+        Generates queries from the current log file as they end, following it forever.
+
+        The position in the log file and the parsing state are saved in the checkpoint file if any, and used to
+        resume from there.
+        """
+        since = self.parse_ts(self.config.since, 'since')
+        current = self.find_current_file()
+        tail = Tail(current, self.config.poll)
+        state = None
+
+        if self.config.checkpoint and os.path.exists(self.config.checkpoint):
+            with open(self.config.checkpoint) as f:
+                checkpoint = json.load(f)
+            state = ParseState.from_dict(checkpoint['state'])
+            # Everything after the checkpoint is new, whatever its timestamp.
+            since = datetime.datetime.min
+
+            # The file of the checkpoint might have been rotated since.
+            for path in [current] + glob.glob('/'.join([self.config.logdir, self.config.logfile_glob])):
+                if os.path.isfile(path) and Tail.stat_identity(os.stat(path)) == checkpoint['identity']:
+                    logging.info("Resuming from {f} at offset {o}.".format(f=path, o=checkpoint['offset']))
+                    tail.open(path, checkpoint['offset'])
+                    break
+            else:
+                logging.warning("File of the checkpoint not found, starting at the beginning of {}.".format(current))
+                tail.open(current)
+        else:
+            offset = self.start_offset(current, since, datetime.datetime.max)
+            tail.open(current, os.path.getsize(current) if offset is None else offset)
+
+        if state is None:
+            state = ParseState()
+
+        def save_checkpoint():
+            if not self.config.checkpoint:
+                return
+            tmp = self.config.checkpoint + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({
+                    'path': tail.f.name,
+                    'identity': tail.identity,
+                    'offset': tail.offset,
+                    'state': state.to_dict(),
+                }, f)
+            os.replace(tmp, self.config.checkpoint)
+
+        counts = self.stats.file(current) if self.stats else None
+        events = self.line_events(tail.lines(save_checkpoint), since, datetime.datetime.max, counts)
+        yield from self.replay_events(events, state)
+
+    def find_current_file(self):
+        """
+        The log file currently written to, the one without date in its name.
+        """
+        for f in glob.glob('/'.join([self.config.logdir, self.config.logfile_glob])):
+            if not re.search('(?P<y>\d{4})(?P<datesep>\D?)(?P<m>\d{2})(?P=datesep)(?P<d>\d{2})', f):
+                return f
+        raise(Exception("No current log file found in {}.".format(self.config.logdir)))
+
     def find_files_to_parse(self, since, to):
         """
         Looks at from and to, and find the relevant files based on their filename, returned in chronological order.
@@ -198,18 +1435,23 @@ class Grep():
     def query_from_dict(self, d, tid):
         """
         Transform a hash in a qery object,
+
+        Short repeated strings (user, host...) are interned, query texts deduplicated.
         """
-        # Will become the returned object
-        Query = collections.namedtuple('Query', ['start', 'user', 'host', 'duration', 'querytype', 'query', 'threadid', 'queryid', 'txnid', 'status', 'error'])
-        return Query(querytype=d['query'][0].lstrip().partition(' ')[0],
-                     query=''.join(d['query']),
+        query = ''.join(d['query'])
+        if len(self.texts) >= self.max_texts:
+            self.texts.clear()
+        query = self.texts.setdefault(query, query)
+
+        return Query(querytype=sys.intern(query_type(query)),
+                     query=query,
 
-                     user=d['user'] if 'user' in d else 'Unknown',
-                     host=d['host'] if 'host' in d else 'Unknown',
-                     duration='{:3f}'.format(int(d['duration']) / 1000) if 'duration' in d else 'Unknown',
-                     start=d['start'] if 'start' in d else 'Unknown',
+                     user=sys.intern(d['user']) if 'user' in d else 'Unknown',
+                     host=sys.intern(d['host']) if 'host' in d else 'Unknown',
+                     duration=int(d['duration']) / 1000 if 'duration' in d else None,
+                     start=(d['start'] - EPOCH).total_seconds(),
 
-                     threadid=tid,
+                     threadid=sys.intern(tid),
                      queryid=d['qid'] if 'qid' in d else 'Unknown',
                      txnid=d['txnid'] if 'txnid' in d else 'Unknown',
 
@@ -218,168 +1460,844 @@ class Grep():
                      error=d['error'] if 'error' in d else None,
                      )
 
-    def extract_queries(self, files, since, to):
+    def start_offset(self, file, since, to):
         """
-        From a list of file path and a since/to pair, extract queries.extract
+        Offset of the first line of a file which might be between since and to, None if there is no such line.
+
+        Uses the index of the file, or a binary search on plain files if indexes are disabled or not writable.
         """
+        since_key = since.strftime('%Y-%m-%d %H:%M:%S')
+        to_key = to.strftime('%Y-%m-%d %H:%M:%S')
 
-        # returned list
-        queries = []
+        if self.config.index_dir:
+            index = LogIndex(file, self.config.index_dir)
+            try:
+                index.update()
+            except OSError as e:
+                logging.warning("Could not index {f}, ignoring index: {e}".format(f=file, e=e))
+            else:
+                if not index.covers(since_key[:16], to_key[:16]):
+                    return None
+                return index.offset(since_key[:16])
 
-        # Multiple queries can run in parallel, with log line intertwined, so we keep a hash of queries we know of.
-        # One a query is fully parsed, its entry is deleted from the hash, so it should never become too big.
-        parsing = {}
+        if LogReader.compressed(file):
+            return 0
+        with open(file, 'rb') as f:
+            return self.bisect_offset(f, since_key.encode())
 
-        # When getting parsing error, here is no good id to extract from the log. Generate it here.
-        handler_id = 0
+    def bisect_offset(self, f, key):
+        """
+        Binary search in a plain file for an offset before which all timestamps are lower than key.
 
-        # pattern that will be look for.
-        re_dt = re.compile('^(?P<dt>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d{3} (?P<log>.*)$')
+        Assumes lines are (mostly) in chronological order, and looks for timestamped lines as some are not.
+        """
+        lo = 0
+        hi = os.fstat(f.fileno()).st_size
+        # Below this, reading is cheaper than seeking around.
+        while hi - lo > 65536:
+            mid = (lo + hi) // 2
+            f.seek(mid)
+            # Probably in the middle of a line, go to the next one.
+            f.readline()
+            pos = f.tell()
+            ts = None
+            for l in iter(f.readline, b''):
+                if LogIndex.re_ts.match(l):
+                    ts = l[:19]
+                    break
+                pos += len(l)
 
-        # Happy flow
-        re_bgpool = re.compile('HiveServer2-Background-Pool: Thread-(?P<tid>\d+)\]: (?P<rest>.*)$')
-        re_endofthread = re.compile('</PERFLOG method=Driver.run .* duration=(?P<duration>\d+) from=org.apache.hadoop.hive.ql.Driver>')
-        re_cmdstart = re.compile('Starting command\(queryId=(?P<qid>\S*)\): (?P<cmd>.*)$')
-        re_meta = re.compile('txnid:(?P<txnid>\S*), user:(?P<user>\S*), hostname:(?P<host>\S*),')
+            if ts is not None and ts < key and pos < hi:
+                lo = pos
+            else:
+                hi = mid
+        return lo
 
-        # Error flow
-        re_handler = re.compile('\[HiveServer2-Handler-Pool.*?\]: (?P<rest>.*)')
-        re_parsing = re.compile('Parsing command: (?P<cmd>.*)')
-        re_handler_error = re.compile('FAILED: (?P<error>.*)')
+    def scan_file(self, file, since, to, stats=False):
+        """
+        Reduce one file to the list of its events, see file_events, and its counters if stats are wanted.
 
-        # A command is special beast as it is a multi line log message, without the Ts and other metadata.
-        # If a command is started, this variable will be set to the thread id.
-        in_command = None
+        This is the function run by the worker processes when using --jobs.
+        """
+        if not stats:
+            return list(self.file_events(file, since, to)), None
+        counts = collections.Counter()
+        start = time.perf_counter()
+        events = list(self.file_events(file, since, to, counts))
+        counts['seconds'] = time.perf_counter() - start
+        return events, counts
 
-        for file in files:
-            logging.debug("opening {}".format(file))
-            if file.endswith('.gz'):
-                f = gzip.open(file)
-            else:
-                f = open(file)
+    def file_events(self, file, since, to, counts=None):
+        """
+        Generates the events relevant to query extraction found in one file.
 
-            for l in f:
-                # predefine vars for easy logging
-                cmdstart = None
-                end = None
-                meta = None
+        If counts is given, it is updated with the counters of the file, see Stats.
+        """
+        offset = self.start_offset(file, since, to)
+        if offset is None:
+            logging.debug("skipping {}, nothing between since and to.".format(file))
+            return
 
-                # Step 1: is the line between from and to?
-                dt_match = re.search(re_dt, l)
-                if dt_match:
-                    log = dt_match.group('log')
-                    dt = datetime.datetime.strptime(dt_match.group('dt'), '%Y-%m-%d %H:%M:%S')
+        logging.debug("opening {f} at offset {o}".format(f=file, o=offset))
+        with LogReader(file, offset) as f:
+            try:
+                yield from self.line_events(f, since, to, counts)
+            finally:
+                if counts is not None:
+                    counts['bytes_read'] += f.bytes_read
+                    counts['bytes_decompressed'] += f.bytes_decompressed
 
-                    if dt > to or dt < since:
-                        continue
-                else:
-                    # Step 1.5: if there is no TS, we might be reading a multiline command
-                    if in_command is not None:
-                        if 'lines' in parsing[in_command]:
-                            parsing[in_command]['lines'] += [l]
-                        parsing[in_command]['query'] += [l]
-                        continue
-                    else:
-                        # probably a multiline exception
-                        continue
+    def line_events(self, lines, since, to, counts=None):
+        """
+        Reduce log lines, as bytes, to a stream of events, which can be replayed by replay_events.
+
+        This is where the expensive work is done (regexes, timestamp parsing), and it does not depend on the state
+        of the previous file, so different files can be scanned in parallel. Lines which can not change the outcome
+        of the extraction are dropped here.
+
+        Events are tuples, the first item being their kind:
+        - ('cont', line): line without timestamp, part of a multiline command if one is being read.
+        - ('reset',): timestamped line ending a multiline command, without anything else of interest.
+        - ('bg', dt, tid, kind, data): line of a HiveServer2-Background-Pool thread.
+          kind is 'cmd' (data: (qid, cmd)), 'meta' (data: (txnid, user, host)), 'end' (data: duration) or None.
+          Lines of a thread with kind None are only kept to know when a thread is still alive, once per minute.
+
+        Timestamps are only compared as strings with since and to, and only decoded for lines giving an event.
+        - ('hparse', dt, cmd): parsing command in the Handler pool.
+        - ('herror', dt, error): failure in the Handler pool.
+
+        If counts is given, it is updated with the number of lines seen, skipped and matched by each pattern.
+        """
+        # Could a line without timestamp be the rest of a multiline command?
+        # At the beginning of a file, this depends on the end of the previous file.
+        maybe_in_command = True
+
+        # Does a thread id exist in the parsing state (True/False), or do we not know because it depends on the
+        # previous file (None)? Lines of a thread known to exist which are not start, meta or end can be dropped.
+        exists = {}
+        # Minute of the last event of each thread.
+        alive = {}
+
+        # Whole seconds in the logs: lines at since's second are before since if it has microseconds.
+        since_key = Timestamps.key(since + datetime.timedelta(microseconds=999999) if since.microsecond else since)
+        to_key = Timestamps.key(to)
+        decode = Timestamps().decode
+        encoding = self.encoding
+
+        # Local names, this loop runs for every single line.
+        re_dt_match = self.re_dt.match
+        re_bgpool = self.re_bgpool
+        re_cmdstart = self.re_cmdstart
+        re_meta = self.re_meta
+        re_endofthread = self.re_endofthread
+        re_handler = self.re_handler
+        re_parsing = self.re_parsing
+        re_handler_error = self.re_handler_error
+        lit_bgpool = self.lit_bgpool
+        lit_cmdstart = self.lit_cmdstart
+        lit_meta = self.lit_meta
+        lit_endofthread = self.lit_endofthread
+        lit_handler = self.lit_handler
+        lit_parsing = self.lit_parsing
+        lit_handler_error = self.lit_handler_error
+
+        # Counters, see Stats.
+        seen = skipped = 0
+        bgpool_hits = cmdstart_hits = meta_hits = endofthread_hits = handler_hits = parsing_hits = error_hits = 0
+
+        try:
+            for l in lines:
+                seen += 1
+                # Matching str is much faster than matching bytes in CPython, even counting the decoding.
+                l = l.decode(encoding, 'replace')
+                # Step 1: is the line between from and to?
+                dt_match = re_dt_match(l)
+                if not dt_match:
+                    # Step 1.5: if there is no TS, we might be reading a multiline command (or a multiline exception)
+                    if maybe_in_command:
+                        yield ('cont', l)
+                    continue
 
-                # We are definitely not in a command anymore, reset the flag.
-                in_command = None
+                ts = l[:19]
+                if ts > to_key:
+                    # Files are chronological, nothing of interest left.
+                    break
+                if ts < since_key:
+                    skipped += 1
+                    continue
 
                 # Step 2: commands are only run in HiveServer2-Background-Pool
-                isbg = re.search(re_bgpool, log)
+                isbg = lit_bgpool in l and re_bgpool.search(l)
                 if isbg:
+                    bgpool_hits += 1
                     tid = isbg.group('tid')
                     rest = isbg.group('rest')
+                    was_in_command = maybe_in_command
+                    maybe_in_command = False
 
-                    if tid not in parsing:
-                        # First occurence of this thread id
-                        parsing[tid] = {
-                            'lines': [l],
-                            'start': dt
-                        }
+                    kind = None
+                    data = None
+                    cmdstart = lit_cmdstart in rest and re_cmdstart.search(rest)
+                    if cmdstart:
+                        cmdstart_hits += 1
+                        kind = 'cmd'
+                        data = (cmdstart.group('qid'), cmdstart.group('cmd'))
+                        maybe_in_command = True
                     else:
-                        # Thread id already exists
-                        cmdstart = re.search(re_cmdstart, rest)
-
-                        # Is the current line a commad start?
-                        if cmdstart:
-                            parsing[tid]['query'] = [cmdstart.group('cmd') + '\n']
-                            parsing[tid]['qid'] = cmdstart.group('qid')
-                            # Next lines might be the rest of a multi line command.
-                            in_command = tid
-                        else:
-                            # Are there interesting metadata on this line?
-                            meta = re.search(re_meta, rest)
-                            if meta:
-                                parsing[tid]['txnid'] = meta.group('txnid')
-                                parsing[tid]['user'] = meta.group('user')
-                                parsing[tid]['host'] = meta.group('host')
-                            else:
-                                # No start, no meta... Is the current line a command end?
-                                end = re.search(re_endofthread, rest)
-                                if end:
-                                    if 'query' in parsing[tid]:
-                                        parsing[tid]['duration'] = end.group('duration')
-                                        parsing[tid]['status'] = 'Probably success'
-                                        queries.append(self.query_from_dict(parsing[tid], tid))
-                                    # Once a command is ended, no need to keep it forever.
-                                    del(parsing[tid])
-                                else:
-                                    # no start, no end, no metatada.. Discard
-                                    pass
-                else:
-                    # Parse and semantic errors are given by the Handler pool, but without nice metadata.
-                    is_handler = re.search(re_handler, log)
-                    if is_handler:
-
-                        is_parsing = re.search(re_parsing, is_handler.group('rest'))
-                        if is_parsing:
-                            handler_id += 1
-                            tid = 'handler-{}'.format(handler_id)
-                            in_command = tid
-                            parsing[tid] = {
-                                'start': dt,
-                                'query': [is_parsing.group('cmd') + '\n'],
-                                'is_handler': True
-                            }
+                        meta = lit_meta in rest and re_meta.search(rest)
+                        if meta:
+                            meta_hits += 1
+                            kind = 'meta'
+                            data = (meta.group('txnid'), meta.group('user'), meta.group('host'))
                         else:
-                            tid = 'handler-{}'.format(handler_id)
-                            is_handler_error = re.search(re_handler_error, is_handler.group('rest'))
-                            if is_handler_error:
-                                parsing[tid]['error'] = is_handler_error.group('error')
-                                parsing[tid]['status'] = 'FAILED'
-                                queries.append(self.query_from_dict(parsing[tid], tid))
-
-                                # Once a command is ended, no need to keep it forever.
-                                del(parsing[tid])
-
-                logging.debug('line {line}: in_command: {cmd}, isbg: {bg}, isstart: {isstart}, isend: {end}, ismeta: {meta}'.format(
-                    line=l,
-                    cmd=in_command,
-                    bg=isbg is not None,
-                    isstart=cmdstart is not None,
-                    end=end is not None,
-                    meta=meta is not None
-                ))
-            f.close()
+                            end = lit_endofthread in rest and re_endofthread.search(rest)
+                            if end:
+                                endofthread_hits += 1
+                                kind = 'end'
+                                data = end.group('duration')
+
+                    known = exists.get(tid)
+                    if kind is None and known and alive[tid] == ts[:16]:
+                        # Nothing to learn from this line, bar the reset of a multiline command.
+                        if was_in_command:
+                            yield ('reset',)
+                        continue
+                    alive[tid] = ts[:16]
+
+                    if kind == 'end':
+                        # An existing thread is deleted at its end, an unknown one is created.
+                        exists[tid] = None if known is None else not known
+                    else:
+                        exists[tid] = True
+                    yield ('bg', decode(ts), tid, kind, data)
+                    continue
+
+                # Parse and semantic errors are given by the Handler pool, but without nice metadata.
+                is_handler = lit_handler in l and re_handler.search(l)
+                if is_handler:
+                    handler_hits += 1
+                    handler_rest = is_handler.group('rest')
+                    is_parsing = lit_parsing in handler_rest and re_parsing.search(handler_rest)
+                    if is_parsing:
+                        parsing_hits += 1
+                        maybe_in_command = True
+                        yield ('hparse', decode(ts), is_parsing.group('cmd'))
+                        continue
+                    is_handler_error = lit_handler_error in handler_rest and re_handler_error.search(handler_rest)
+                    if is_handler_error:
+                        error_hits += 1
+                        maybe_in_command = False
+                        yield ('herror', decode(ts), is_handler_error.group('error'))
+                        continue
+
+                # We are definitely not in a command anymore.
+                if maybe_in_command:
+                    maybe_in_command = False
+                    yield ('reset',)
+        finally:
+            if counts is not None:
+                counts.update({
+                    'lines': seen,
+                    'lines_skipped': skipped,
+                    're_bgpool': bgpool_hits,
+                    're_cmdstart': cmdstart_hits,
+                    're_meta': meta_hits,
+                    're_endofthread': endofthread_hits,
+                    're_handler': handler_hits,
+                    're_parsing': parsing_hits,
+                    're_handler_error': error_hits,
+                })
+
+    def replay_events(self, events, state):
+        """
+        Apply events (see line_events) to the parsing state, generating queries as they complete.
+        """
+        parsing = state.parsing
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        stats = self.stats
+        source = self.source
+
+        for event in events:
+            if debug:
+                logging.debug('event {event}: in_command: {cmd}'.format(event=event, cmd=state.in_command))
+
+            if event[0] == 'cont':
+                if state.in_command is not None:
+                    parsing[state.in_command]['query'] += [event[1]]
+                continue
+
+            # We are definitely not in a command anymore, reset the flag.
+            state.in_command = None
+
+            if event[0] == 'reset':
+                continue
+
+            dt = event[1]
+            state.clock = dt
+            if dt >= state.next_eviction:
+                yield from self.evict_idle(state, dt)
+
+            if event[0] == 'bg':
+                _, dt, tid, kind, data = event
+
+                if tid not in parsing:
+                    # First occurence of this thread id
+                    parsing[tid] = {
+                        'start': dt,
+                        'last': dt
+                    }
+                    if self.filter.rejects_thread(handler=False):
+                        parsing[tid]['rejected'] = True
+                    if stats is not None and len(parsing) > stats.peak_parsing[source]:
+                        stats.peak_parsing[source] = len(parsing)
+                    continue
+
+                parsing[tid]['last'] = dt
+                if kind == 'cmd':
+                    if 'rejected' in parsing[tid]:
+                        continue
+                    if self.filter.rejects_command(data[1]):
+                        self.reject(parsing[tid])
+                        continue
+                    parsing[tid]['query'] = [data[1] + '\n']
+                    parsing[tid]['qid'] = data[0]
+                    # Next lines might be the rest of a multi line command.
+                    state.in_command = tid
+                elif kind == 'meta':
+                    if 'rejected' in parsing[tid]:
+                        continue
+                    if self.filter.rejects_user(data[1]):
+                        self.reject(parsing[tid])
+                        continue
+                    parsing[tid]['txnid'], parsing[tid]['user'], parsing[tid]['host'] = data
+                elif kind == 'end':
+                    if 'query' in parsing[tid]:
+                        parsing[tid]['duration'] = data
+                        parsing[tid]['status'] = 'Probably success'
+                        if self.filter.accepts(parsing[tid]):
+                            yield self.query_from_dict(parsing[tid], tid)
+                    # Once a command is ended, no need to keep it forever.
+                    del(parsing[tid])
+
+            elif event[0] == 'hparse':
+                _, dt, cmd = event
+                # Errors are always for the last parsed command, the previous one cannot fail anymore.
+                parsing.pop('handler-{}'.format(state.handler_id), None)
+                state.handler_id += 1
+                tid = 'handler-{}'.format(state.handler_id)
+                state.in_command = tid
+                parsing[tid] = {
+                    'start': dt,
+                    'last': dt,
+                    'query': [cmd + '\n'],
+                    'is_handler': True
+                }
+                if self.filter.rejects_thread(handler=True) or self.filter.rejects_command(cmd):
+                    self.reject(parsing[tid])
+                    state.in_command = None
+                if stats is not None and len(parsing) > stats.peak_parsing[source]:
+                    stats.peak_parsing[source] = len(parsing)
+
+            elif event[0] == 'herror':
+                _, dt, error = event
+                tid = 'handler-{}'.format(state.handler_id)
+                if tid not in parsing:
+                    # Its command was before the logs we read, eg. when following from the end of the file.
+                    continue
+                parsing[tid]['error'] = error
+                parsing[tid]['status'] = 'FAILED'
+                if 'query' in parsing[tid] and self.filter.accepts(parsing[tid]):
+                    yield self.query_from_dict(parsing[tid], tid)
+
+                # Once a command is ended, no need to keep it forever.
+                del(parsing[tid])
+
+    def reject(self, d):
+        """
+        Marks a thread as not matching the filters. Its entry is kept, only to know its next lines are not the first.
+        """
+        d.pop('query', None)
+        d['rejected'] = True
+
+    def evict_idle(self, state, now):
+        """
+        Forget about queries idle for more than max_idle, generating the ones which started as Unfinished.
+
+        This runs at most once per minute of logs.
+        """
+        state.next_eviction = now + datetime.timedelta(minutes=1)
+        limit = now - self.max_idle
+        for tid in [tid for tid, d in state.parsing.items() if d['last'] < limit]:
+            d = state.parsing.pop(tid)
+            if tid == state.in_command:
+                state.in_command = None
+            if 'query' in d and 'is_handler' not in d:
+                logging.debug("Evicting idle thread {}.".format(tid))
+                d['status'] = 'Unfinished'
+                if self.filter.accepts(d):
+                    yield self.query_from_dict(d, tid)
+
+    def running_queries(self, state):
+        """
+        Generates the queries not completed once all files are read.
+        """
+        for tid in state.parsing:
+            if 'query' in state.parsing[tid] and 'is_handler' not in state.parsing[tid]:
+                state.parsing[tid]['status'] = 'Running'
+                if self.filter.accepts(state.parsing[tid]):
+                    yield self.query_from_dict(state.parsing[tid], tid)
+
+    def scan_files(self, files, since, to):
+        """
+        Generates, in order, the events of each file.
+
+        With more than one job, files are scanned in parallel by a pool of processes.
+        """
+        if self.config.jobs > 1 and len(files) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(self.config.jobs, len(files))) as executor:
+                # Only scan a few files ahead, not to keep the events of all of them in memory.
+                pending = collections.deque()
+                for file in files:
+                    pending.append((file, executor.submit(self.scan_file, file, since, to, self.stats is not None)))
+                    if len(pending) > self.config.jobs:
+                        yield self.scanned(*pending.popleft())
+                while pending:
+                    yield self.scanned(*pending.popleft())
+        elif self.stats:
+            for file in files:
+                counts = self.stats.file(file)
+                yield self.stats.timed(self.file_events(file, since, to, counts), 'seconds', into=counts)
+        else:
+            for file in files:
+                yield self.file_events(file, since, to)
+
+    def scanned(self, file, future):
+        """
+        Events of a file scanned by a worker process, keeping its counters.
+        """
+        events, counts = future.result()
+        if counts is not None:
+            self.stats.file(file).update(counts)
+        return events
+
+    def extract_queries(self, files, since, to, state=None):
+        """
+        From a list of file path and a since/to pair, generates queries as they are found.
+
+        Files are scanned independently (see scan_files), their events are then replayed in order against a single
+        parsing state, so that a query spanning a file boundary is stitched back together.
+        """
+        if state is None:
+            state = ParseState()
+        if self.stats:
+            parallel = self.config.jobs > 1 and len(files) > 1
+            scans = self.scan_files(files, since, to)
+            if parallel:
+                scans = self.stats.timed(scans, 'waiting for workers')
+            for events in scans:
+                yield from self.stats.timed(self.replay_events(events, state), 'replay')
+            # Time scanning each file is counted with the file, in worker processes or in this one.
+            if not parallel:
+                self.stats.seconds['scan'] += sum(self.stats.file(f)['seconds'] for f in files)
+        else:
+            for events in self.scan_files(files, since, to):
+                yield from self.replay_events(events, state)
+
+        # Maybe there are queries not completed
+        yield from self.running_queries(state)
+
+    def ordered_queries(self, files, since, to):
+        """
+        Same as extract_queries, ordered by start time.
+
+        Queries are found when they end, so they are held back until no query being parsed, nor any query starting
+        after the last line read, can have started before them.
+        """
+        state = ParseState()
+        pending = []
+        # Tie breaker, queries are not comparable.
+        seq = itertools.count()
+        for q in self.extract_queries(files, since, to, state):
+            heapq.heappush(pending, (q.start, next(seq), q))
+            watermark = min([d['start'] for d in state.parsing.values()] + [state.clock])
+            watermark = (watermark - EPOCH).total_seconds()
+            while pending and pending[0][0] < watermark:
+                yield heapq.heappop(pending)[2]
+
+        while pending:
+            yield heapq.heappop(pending)[2]
+
+
+def in_background(iterable, size=1000):
+    """
+    Consumes an iterable in a thread, generating its items through a bounded queue.
+
+    When the generator is closed before the end, the thread stops (and closes iterable) at its next item.
+    """
+    q = queue.Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(done)
+        except Exception as e:
+            put(e)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = q.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise(item)
+            yield item
+    finally:
+        stop.set()
+
+
+def tagged(queries, server):
+    for q in queries:
+        q.server = server
+        yield q
+
+
+def merged_queries(config, stats=None):
+    """
+    Generates queries of all the sources of config, ordered by start time and tagged with their source name.
+
+    Each source is parsed independently in its own thread (and its own processes with --jobs), and their ordered
+    streams are merged as they come.
+    """
+    streams = []
+    for source in config.sources:
+        name, sep, location = source.partition('=')
+        if not sep:
+            raise(Exception('Source not understood, expected name=logdir[:glob]: "{}"'.format(source)))
+        logdir, _, logfile_glob = location.partition(':')
+
+        source_config = copy.copy(config)
+        source_config.logdir = logdir
+        source_config.logfile_glob = logfile_glob or config.logfile_glob
+        grep = Grep(source_config)
+        grep.stats = stats
+        grep.source = name
+        streams.append(in_background(tagged(grep.get_queries(ordered=True), name)))
+
+    return heapq.merge(*streams, key=lambda q: q.start)
+
+
+class QueryStore():
+    """
+    SQLite database of queries, fed incrementally from the log files.
+
+    Files are recognised by a hash of their first bytes, which does not change when the current log file is rotated,
+    even if it is compressed. For each file, the database knows up to where it has been parsed. The parsing state at
+    this point (queries not ended yet) is kept as well, so that the next ingestion carries on exactly from there.
+    """
+
+    # Number of bytes hashed to recognise a file. Smaller files are not ingested yet.
+    identity_size = 4096
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS queries (
+            start REAL NOT NULL,
+            user TEXT,
+            host TEXT,
+            duration REAL,
+            querytype TEXT,
+            query TEXT,
+            threadid TEXT,
+            queryid TEXT,
+            txnid TEXT,
+            status TEXT,
+            error TEXT,
+            server TEXT
+        );
+        CREATE INDEX IF NOT EXISTS queries_start ON queries (start);
+        CREATE INDEX IF NOT EXISTS queries_user ON queries (user, start);
+        CREATE INDEX IF NOT EXISTS queries_status ON queries (status, start);
+        CREATE INDEX IF NOT EXISTS queries_queryid ON queries (queryid);
+
+        CREATE TABLE IF NOT EXISTS files (
+            identity TEXT PRIMARY KEY,
+            path TEXT,
+            offset INTEGER NOT NULL,
+            complete INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS state (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            state TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(self.schema)
+        # Databases created before queries had a server.
+        if 'server' not in [c[1] for c in self.conn.execute('PRAGMA table_info(queries)')]:
+            self.conn.execute('ALTER TABLE queries ADD COLUMN server TEXT')
+
+    def file_identity(self, file):
+        head = b''
+        with LogReader(file) as f:
+            for l in f:
+                head += l
+                if len(head) >= self.identity_size:
+                    break
+        head = head[:self.identity_size]
+        if len(head) < self.identity_size:
+            return None
+        return hashlib.sha1(head).hexdigest()
+
+    def ingest(self, grep):
+        """
+        Parses what is new in the log files, in chronological order, and stores its queries.
+
+        All queries are stored, whatever the filters. Returns the number of queries stored.
+        """
+        grep = copy.copy(grep)
+        grep.filter = QueryFilter()
+        row = self.conn.execute('SELECT state FROM state WHERE id = 0').fetchone()
+        state = ParseState.from_dict(json.loads(row[0])) if row else ParseState()
+
+        stored = 0
+        for file in grep.find_files_to_parse(datetime.datetime.min, datetime.datetime.max):
+            identity = self.file_identity(file)
+            if identity is None:
+                logging.info("{} is too small to be ingested yet.".format(file))
+                continue
+
+            row = self.conn.execute('SELECT offset, complete FROM files WHERE identity = ?', (identity,)).fetchone()
+            offset, complete = row if row else (0, False)
+            if complete:
+                logging.debug("{} already ingested.".format(file))
+                continue
+
+            # Rolled files, with a date in their name, are not written to anymore.
+            complete = re.search('(?P<y>\d{4})(?P<datesep>\D?)(?P<m>\d{2})(?P=datesep)(?P<d>\d{2})', file) is not None
+            position = {'offset': offset}
+            lines = self.read_lines(file, position, complete)
+            counts = grep.stats.file(file) if grep.stats else None
+            events = grep.line_events(lines, datetime.datetime.min, datetime.datetime.max, counts)
+
+            logging.info("Ingesting {f} from offset {o}.".format(f=file, o=offset))
+            with self.conn:
+                before = self.conn.total_changes
+                self.conn.executemany(
+                    'INSERT INTO queries ({}) VALUES ({})'.format(
+                        ', '.join(Query.__slots__),
+                        ', '.join('?' * len(Query.__slots__))
+                    ),
+                    ([getattr(q, f) for f in Query.__slots__] for q in grep.replay_events(events, state))
+                )
+                stored += self.conn.total_changes - before
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO files (identity, path, offset, complete) VALUES (?, ?, ?, ?)',
+                    (identity, file, position['offset'], complete)
+                )
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO state (id, state) VALUES (0, ?)',
+                    (json.dumps(state.to_dict()),)
+                )
+
+        return stored
+
+    def read_lines(self, file, position, complete):
+        """
+        Generates the lines of a file from position['offset'], keeping it up to date with what has been read.
+
+        Unless the file is complete, a last line without end of line is still being written, and not read.
+        """
+        with LogReader(file, position['offset']) as f:
+            for l in f:
+                if not complete and not l.endswith(b'\n'):
+                    break
+                position['offset'] += len(l)
+                yield l
+
+    def queries(self, since, to, query_filter=None):
+        """
+        Generates queries started between since and to, meeting the criteria of query_filter, by start time.
+        """
+        where = ['start BETWEEN ? AND ?']
+        params = [(since - EPOCH).total_seconds(), (to - EPOCH).total_seconds()]
+        f = query_filter or QueryFilter()
+        if f.user is not None:
+            where.append('user = ?')
+            params.append(f.user)
+        if f.status is not None:
+            where.append('status = ?')
+            params.append(f.status)
+        if f.min_duration is not None:
+            where.append('duration >= ?')
+            params.append(f.min_duration)
+        if f.querytype is not None:
+            # Rows stored by older versions can have a line feed after the type.
+            where.append('lower(rtrim(querytype, char(10))) = ?')
+            params.append(f.querytype)
+        if f.query_regex is not None:
+            # sqlite has the REGEXP operator, but no function behind it.
+            self.conn.create_function('REGEXP', 2, lambda pattern, s: f.query_regex.search(s) is not None)
+            where.append('query REGEXP ?')
+            params.append(f.query_regex.pattern)
+
+        cursor = self.conn.execute(
+            'SELECT {} FROM queries WHERE {} ORDER BY start'.format(', '.join(Query.__slots__), ' AND '.join(where)),
+            params
+        )
+        for row in cursor:
+            yield Query(*row)
+
+
+class QueryService():
+    """
+    Keeps the last queries found while following the logs in memory, and answers lookups over HTTP.
+
+    GET /queries gives the queries, as a json list by end time, filtered by any of the parameters user, status,
+    min_duration, query_regex, type, since and to (as --since and --to), limit (most recent ones kept).
+    GET /status gives the number of queries kept and their time range, and the error which stopped following the
+    logs, if any.
+    """
+
+    def __init__(self, grep, size):
+        self.grep = grep
+        self.queries = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.error = None
+
+    def feed(self, queries):
+        """
+        Keeps queries as they come, forever with follow_queries. Old ones are forgotten past the buffer size.
+        """
+        for q in queries:
+            with self.lock:
+                self.queries.append(q)
+
+    def lookup(self, query_filter, since=None, to=None, limit=None):
+        """
+        Queries kept which meet the criteria of query_filter, started between since and to if given.
+        """
+        since = None if since is None else (since - EPOCH).total_seconds()
+        to = None if to is None else (to - EPOCH).total_seconds()
+        with self.lock:
+            queries = list(self.queries)
+        found = [
+            q for q in queries
+            if (since is None or q.start >= since) and (to is None or q.start <= to) and query_filter.matches(q)
+        ]
+        return found[-limit:] if limit else found
+
+    def status(self):
+        with self.lock:
+            starts = [q.start for q in self.queries]
+        return {
+            'queries': len(starts),
+            'size': self.queries.maxlen,
+            'oldest_start': min(starts) if starts else None,
+            'newest_start': max(starts) if starts else None,
+            'error': self.error,
+        }
+
+    def answer(self, path):
+        """
+        Http status and json answer to a GET request.
+        """
+        url = urllib.parse.urlsplit(path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            if url.path == '/status':
+                return 200, self.status()
+            if url.path == '/queries':
+                query_filter = QueryFilter(
+                    user=params.get('user'),
+                    status=params.get('status'),
+                    min_duration=float(params['min_duration']) if 'min_duration' in params else None,
+                    query_regex=params.get('query_regex'),
+                    querytype=params.get('type')
+                )
+                found = self.lookup(
+                    query_filter,
+                    since=self.grep.parse_ts(params['since'], 'since') if 'since' in params else None,
+                    to=self.grep.parse_ts(params['to'], 'to') if 'to' in params else None,
+                    limit=int(params['limit']) if 'limit' in params else None
+                )
+                return 200, [q.to_dict() for q in found]
+        except Exception as e:
+            return 400, {'error': str(e)}
+        return 404, {'error': 'Unknown path {}, expected /queries or /status.'.format(url.path)}
+
+    def server(self, address):
+        """
+        Http server on host:port, or on a Unix socket with unix:path.
+        """
+        service = self
 
-        for tid in parsing:
-            # Maybe there are queries not completed
-            if 'query' in parsing[tid] and 'is_handler' not in parsing[tid]:
-                parsing[tid]['status'] = 'Running'
-                queries.append(self.query_from_dict(parsing[tid], tid))
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                code, answer = service.answer(self.path)
+                body = json.dumps(answer).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        if address.startswith('unix:'):
+            path = address[len('unix:'):]
+            if os.path.exists(path):
+                os.remove(path)
+            return socketserver.ThreadingUnixStreamServer(path, Handler)
+        host, _, port = address.rpartition(':')
+        return http.server.ThreadingHTTPServer((host or 'localhost', int(port)), Handler)
+
+    def follow(self, server):
+        """
+        Feeds the queries of the logs. If following fails, the server is stopped: stale answers would look healthy.
+        """
+        try:
+            self.feed(self.grep.follow_queries())
+        except Exception as e:
+            logging.exception("Could not follow the logs, stopping.")
+            self.error = '{}: {}'.format(type(e).__name__, e)
+            server.shutdown()
 
-        return queries
+    def serve(self, address):
+        """
+        Follows the logs in a thread, and answers lookups until interrupted or until following the logs fails.
+        """
+        with self.server(address) as server:
+            threading.Thread(target=self.follow, args=(server,), daemon=True).start()
+            logging.info("Serving queries on {}.".format(address))
+            server.serve_forever()
+        if self.error:
+            raise(Exception('Stopped serving, following the logs failed: {}'.format(self.error)))
 
 
-config = Config()
-grep = Grep(config)
-qs = grep.get_queries()
-for q in qs:
-    print("Started at {start} for {duration}s by {user} on {host} ({status}). (Thread id: {tid}, query id: {qid}, txn id: {txnid}):\n{q}\n{error}".format(
-        start=q.start,
-        duration=q.duration,
+def format_query(q):
+    return "{server}Started at {start} for {duration}s by {user} on {host} ({status}). (Thread id: {tid}, query id: {qid}, txn id: {txnid}):\n{q}\n{error}".format(
+        start=q.start_datetime(),
+        duration='Unknown' if q.duration is None else '{:3f}'.format(q.duration),
         user=q.user,
         host=q.host,
         tid=q.threadid,
@@ -387,5 +2305,279 @@ for q in qs:
         txnid=q.txnid,
         q=q.query.strip(),
         status=q.status,
-        error="Error: {}\n".format(q.error) if q.error else ''
-    ))
+        error="Error: {}\n".format(q.error) if q.error else '',
+        server='[{}] '.format(q.server) if q.server else ''
+    )
+
+
+def chunked(iterable, size):
+    """
+    Generates lists of at most size items of iterable.
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Writer():
+    """
+    Writes a stream of queries to a file, a batch of queries at a time.
+
+    With flush, each query is written as soon as it comes, eg. when following the logs.
+    """
+
+    # Whether the file is written as bytes.
+    binary = False
+    batch_size = 10000
+
+    def __init__(self, out, flush=False):
+        self.out = out
+        self.flush = flush
+        if flush:
+            self.batch_size = 1
+
+    def write(self, queries):
+        self.begin()
+        for batch in chunked(queries, self.batch_size):
+            self.write_batch(batch)
+            if self.flush:
+                self.out.flush()
+        self.end()
+
+    def begin(self):
+        pass
+
+    def write_batch(self, batch):
+        raise(NotImplementedError())
+
+    def end(self):
+        pass
+
+
+class TextWriter(Writer):
+    """
+    Human readable output.
+    """
+
+    def write_batch(self, batch):
+        self.out.write(''.join(format_query(q) + '\n' for q in batch))
+
+
+class JsonLinesWriter(Writer):
+    """
+    One json object per line, see Query.to_dict.
+    """
+
+    def write_batch(self, batch):
+        self.out.write(''.join(json.dumps(q.to_dict()) + '\n' for q in batch))
+
+
+class CsvWriter(Writer):
+    """
+    Csv with a header, one column per field of Query and start_time.
+    """
+
+    def begin(self):
+        self.csv = csv.writer(self.out)
+        self.csv.writerow(Query.__slots__ + ('start_time',))
+
+    def write_batch(self, batch):
+        self.csv.writerows(
+            [getattr(q, f) for f in Query.__slots__] + [q.start_datetime().isoformat(' ')] for q in batch
+        )
+
+
+class ColumnarWriter(Writer):
+    """
+    Binary file with a column per field, written from batches of queries stored as columns (see QueryBatch).
+    """
+
+    binary = True
+    batch_size = 65536
+
+    def write(self, queries):
+        self.begin()
+        for batch in QueryBatch.batches(queries, self.batch_size):
+            self.write_batch(batch)
+        self.end()
+
+
+class ParquetWriter(ColumnarWriter):
+    """
+    Parquet file, one row group per batch. Needs pyarrow.
+
+    start is an epoch timestamp and duration in seconds (null if unknown), as in Query.
+    """
+
+    def begin(self):
+        # Imported only when needed, it takes a while.
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise(Exception('Parquet output needs the pyarrow module.'))
+        self.pyarrow = pyarrow
+        fields = [pyarrow.field('start', pyarrow.float64()), pyarrow.field('duration', pyarrow.float64())]
+        fields += [pyarrow.field(f, pyarrow.string()) for f in Query.__slots__ if f not in ('start', 'duration')]
+        self.schema = pyarrow.schema(fields)
+        self.parquet = pyarrow.parquet.ParquetWriter(self.out, self.schema)
+
+    def write_batch(self, batch):
+        pyarrow = self.pyarrow
+        columns = {
+            'start': pyarrow.array(batch.start, pyarrow.float64()),
+            # Unknown durations are NaN in the batch.
+            'duration': pyarrow.array([None if d != d else d for d in batch.duration], pyarrow.float64()),
+        }
+        for f, column in batch.columns.items():
+            columns[f] = pyarrow.array(column, pyarrow.string())
+        self.parquet.write_table(pyarrow.table(columns, schema=self.schema))
+
+    def end(self):
+        self.parquet.close()
+
+
+class NpzWriter(ColumnarWriter):
+    """
+    Numpy .npz file, an array per field of Query, to be loaded with numpy.load.
+
+    start and duration are doubles (NaN if the duration is unknown). Strings are dictionary encoded: the array of a
+    field holds indexes in the array of its distinct values (field_values), -1 for None.
+    """
+
+    binary = True
+
+    def begin(self):
+        # Imported only when needed, it takes a while.
+        try:
+            import numpy
+        except ImportError:
+            raise(Exception('Npz output needs the numpy module.'))
+        self.numpy = numpy
+        self.batch = QueryBatch()
+        self.codes = {f: array.array('i') for f in self.batch.columns}
+        self.values = {f: {} for f in self.batch.columns}
+
+    def write_batch(self, batch):
+        # Everything is kept until the end, strings only once.
+        self.batch.start.extend(batch.start)
+        self.batch.duration.extend(batch.duration)
+        for f, column in batch.columns.items():
+            values = self.values[f]
+            self.codes[f].extend(-1 if v is None else values.setdefault(v, len(values)) for v in column)
+
+    def end(self):
+        numpy = self.numpy
+        arrays = {
+            'start': numpy.frombuffer(self.batch.start, dtype=numpy.float64),
+            'duration': numpy.frombuffer(self.batch.duration, dtype=numpy.float64),
+        }
+        for f, codes in self.codes.items():
+            arrays[f] = numpy.frombuffer(codes, dtype=numpy.int32)
+            arrays[f + '_values'] = numpy.array(list(self.values[f]), dtype=str)
+        numpy.savez_compressed(self.out, **arrays)
+
+
+WRITERS = {
+    'text': TextWriter,
+    'jsonl': JsonLinesWriter,
+    'csv': CsvWriter,
+    'parquet': ParquetWriter,
+    'npz': NpzWriter,
+    # Chosen by writer_class.
+    'columnar': ColumnarWriter,
+}
+
+
+def writer_class(name):
+    """
+    Writer of a format. columnar is parquet if pyarrow is available, npz otherwise.
+    """
+    if name == 'columnar':
+        # Only looks for pyarrow, without importing it.
+        return ParquetWriter if importlib.util.find_spec('pyarrow') is not None else NpzWriter
+    return WRITERS[name]
+
+
+def open_output(config):
+    """
+    Writer of the format of config, on its output.
+    """
+    writer = writer_class(config.format)
+    if config.output == '-':
+        out = sys.stdout.buffer if writer.binary else sys.stdout
+    elif writer.binary:
+        out = open(config.output, 'wb')
+    else:
+        out = open(config.output, 'w', newline='' if config.format == 'csv' else None, buffering=1 << 20)
+    return writer(out, flush=config.follow)
+
+
+def main():
+    config = Config()
+    logging.basicConfig(level=config.loglevel)
+    profile = None
+    if config.profile:
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        run(config)
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(config.profile)
+
+
+def run(config):
+    grep = Grep(config)
+    if config.stats:
+        grep.stats = Stats()
+        # Shown even when interrupted, eg. in follow mode.
+        atexit.register(lambda: print(grep.stats.report(), file=sys.stderr))
+    if config.serve:
+        QueryService(grep, config.buffer).serve(config.serve)
+        return
+    if config.db:
+        store = QueryStore(config.db)
+        if config.ingest:
+            logging.info("{} queries ingested.".format(store.ingest(grep)))
+            return
+        qs = store.queries(
+            grep.parse_ts(config.since, 'since'),
+            grep.parse_ts(config.to, 'to'),
+            grep.filter
+        )
+    elif config.follow:
+        qs = grep.follow_queries()
+    elif config.sources:
+        qs = merged_queries(config, grep.stats)
+    else:
+        qs = grep.get_queries()
+    if grep.stats and config.sources:
+        # Parsing is timed in the thread of each source, the main thread only waits for them.
+        qs = grep.stats.timed(grep.stats.counted(qs), 'merging sources', into=grep.stats.waits)
+    elif grep.stats:
+        qs = grep.stats.timed(grep.stats.counted(qs), 'ordering, merging and database reads')
+    if config.aggregate:
+        aggregator = Aggregator()
+        for q in qs:
+            aggregator.add(q)
+        if config.output == '-':
+            print(aggregator.report(config.top))
+        else:
+            with open(config.output, 'w') as out:
+                print(aggregator.report(config.top), file=out)
+        return
+
+    writer = open_output(config)
+    writer.write(qs)
+    if writer.out not in (sys.stdout, sys.stdout.buffer):
+        writer.out.close()
+
+
+# Worker processes of --jobs might import this module, do not run anything then.
+if __name__ == '__main__':
+    main()
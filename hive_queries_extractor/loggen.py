@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic HiveServer2 log generator.
+
+Writes realistic hiveserver2.log.yyyy-mm-dd files (plain or gzipped), rolled per day, of any size. Queries run
+in interleaved HiveServer2-Background-Pool threads, some commands span several lines, some commands fail to parse
+in the HiveServer2-Handler-Pool, and exceptions with their stack trace are thrown around. Most lines are noise, as
+in real logs.
+
+Next to the logs, expected.jsonl lists the queries hqe is expected to extract, and expected.summary.json tells how
+many lines and bytes were written, and between which timestamps.
+"""
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+
+# Same as hqe.EPOCH, timestamps of the logs are naive UTC datetimes.
+EPOCH = datetime.datetime(1970, 1, 1)
+
+TABLES = ['sales', 'customers', 'clicks', 'orders', 'sessions', 'events', 'inventory', 'payments']
+USERS = ['etl', 'analyst', 'reporting', 'hue', 'airflow', 'datasci']
+HOSTS = ['edge1.example.com', 'edge2.example.com', 'gateway.example.com', '10.0.42.7']
+ERRORS = [
+    'ParseException line 1:0 cannot recognize input near \'selec\' \'*\' \'from\'',
+    'SemanticException [Error 10001]: Line 1:14 Table not found \'nope\'',
+    'SemanticException [Error 10004]: Line 1:7 Invalid table alias or column reference \'x\'',
+]
+
+
+def query_key(start, user, host, duration, status, query, queryid):
+    """
+    What must be the same between an expected and an extracted query.
+    """
+    return '\x00'.join([
+        '{:.0f}'.format(start),
+        user,
+        host,
+        '-' if duration is None else '{:.3f}'.format(duration),
+        status,
+        query.strip(),
+        queryid,
+    ]).encode()
+
+
+class Digest():
+    """
+    Order independent digest of a set of queries, in constant memory.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+
+    def add(self, key):
+        self.count += 1
+        self.sum = (self.sum + int.from_bytes(hashlib.sha1(key).digest()[:8], 'big')) % 2 ** 64
+
+    def __eq__(self, other):
+        return (self.count, self.sum) == (other.count, other.sum)
+
+
+class LogGenerator():
+    """
+    Generates log lines and the queries which should be extracted from them.
+
+    lines() yields strings (log lines, with their end of line) and dicts (expected queries, as soon as their last
+    line is generated).
+    """
+
+    def __init__(self, start, seconds, nb_lines, threads=50, seed=42):
+        self.rnd = random.Random(seed)
+        self.dt = start
+        # Average time between two lines.
+        self.step = seconds / max(nb_lines, 1)
+        self.nb_lines = nb_lines
+        self.threads = threads
+
+        # Queries being run, per thread id.
+        self.active = {}
+        self.qid = 0
+        self.txnid = 1000
+        self.handler_thread = 0
+
+    def ts(self):
+        return self.dt.strftime('%Y-%m-%d %H:%M:%S') + ',{:03d} '.format(self.dt.microsecond // 1000)
+
+    def epoch(self):
+        return (self.dt.replace(microsecond=0) - EPOCH).total_seconds()
+
+    def command(self):
+        """
+        A random command, as a list of lines.
+        """
+        rnd = self.rnd
+        table = rnd.choice(TABLES)
+        kind = rnd.random()
+        if kind < 0.4:
+            return ['select * from {} where id = {}'.format(table, rnd.randint(1, 10 ** 6))]
+        if kind < 0.6:
+            return [
+                'select dt, count(*)',
+                'from {}'.format(table),
+                'where dt >= \'2016-01-{:02d}\' and country in ({})'.format(
+                    rnd.randint(1, 28),
+                    ', '.join('\'{}\''.format(rnd.choice(['fr', 'nl', 'de', 'uk', 'us'])) for _ in range(rnd.randint(1, 5)))
+                ),
+                'group by dt',
+            ]
+        if kind < 0.8:
+            return ['insert into table {}_agg select * from {} where amount > {}.{}'.format(
+                table, table, rnd.randint(0, 999), rnd.randint(0, 99))]
+        if kind < 0.9:
+            return ['use default']
+        return ['show partitions {}'.format(table)]
+
+    def lines(self):
+        rnd = self.rnd
+        for _ in range(self.nb_lines):
+            self.dt += datetime.timedelta(seconds=rnd.uniform(0, 2 * self.step))
+            ts = self.ts()
+            r = rnd.random()
+
+            if r < 0.35:
+                yield ts + 'INFO  [main]: metastore.HiveMetaStore (HiveMetaStore.java:logInfo(746)) - {}: get_table : db=default tbl={}\n'.format(
+                    rnd.randint(1, 9), rnd.choice(TABLES))
+            elif r < 0.45:
+                yield ts + 'INFO  [HiveServer2-Handler-Pool: Thread-{}]: thrift.ThriftCLIService (ThriftCLIService.java:OpenSession(294)) - Client protocol version: HIVE_CLI_SERVICE_PROTOCOL_V8\n'.format(
+                    rnd.randint(30, 60))
+            elif r < 0.47:
+                yield from self.parse_failure(ts)
+            elif r < 0.48 and self.active:
+                tid = rnd.choice(list(self.active))
+                yield ts + 'ERROR [HiveServer2-Background-Pool: Thread-{}]: exec.Task (SessionState.java:printError(960)) - Job Submission failed with exception \'java.io.IOException(Connection reset by peer)\'\n'.format(tid)
+                yield 'java.io.IOException: Connection reset by peer\n'
+                for _ in range(rnd.randint(1, 4)):
+                    yield '\tat org.apache.hadoop.hive.ql.exec.Task.executeTask(Task.java:{})\n'.format(rnd.randint(100, 999))
+            elif r < 0.75 and self.active:
+                tid = rnd.choice(list(self.active))
+                yield ts + 'INFO  [HiveServer2-Background-Pool: Thread-{}]: exec.Task (SessionState.java:printInfo(951)) - Stage-1 map = {}%,  reduce = 0%\n'.format(
+                    tid, rnd.randint(0, 100))
+            else:
+                yield from self.advance(ts)
+
+        # Ends all the queries still running, so that all are known.
+        while self.active:
+            self.dt += datetime.timedelta(seconds=rnd.uniform(0, 2 * self.step))
+            yield from self.advance(self.ts(), end=True)
+
+    def parse_failure(self, ts):
+        rnd = self.rnd
+        self.handler_thread = rnd.randint(30, 60)
+        command = ['selec * from {}'.format(rnd.choice(TABLES))] + ['where x = {}'.format(i) for i in range(rnd.randint(0, 2))]
+        error = rnd.choice(ERRORS)
+        yield ts + 'INFO  [HiveServer2-Handler-Pool: Thread-{}]: parse.ParseDriver (ParseDriver.java:parse(185)) - Parsing command: {}\n'.format(
+            self.handler_thread, command[0])
+        for c in command[1:]:
+            yield c + '\n'
+        yield ts + 'ERROR [HiveServer2-Handler-Pool: Thread-{}]: ql.Driver (SessionState.java:printError(960)) - FAILED: {}\n'.format(
+            self.handler_thread, error)
+        yield {
+            'start': self.epoch(),
+            'user': 'Unknown',
+            'host': 'Unknown',
+            'duration': None,
+            'status': 'FAILED',
+            'query': '\n'.join(command),
+            'queryid': 'Unknown',
+        }
+
+    def advance(self, ts, end=False):
+        """
+        Starts a query in an idle thread, or moves an active one to its next step.
+        """
+        rnd = self.rnd
+        idle = [t for t in range(1, self.threads + 1) if t not in self.active]
+        if idle and not end and (not self.active or rnd.random() < 0.3):
+            tid = rnd.choice(idle)
+            self.active[tid] = {'step': 'compile', 'start': self.epoch()}
+            yield ts + 'INFO  [HiveServer2-Background-Pool: Thread-{}]: ql.Driver (Driver.java:compile(411)) - Compiling command(queryId=hive_{})\n'.format(
+                tid, self.qid + 1)
+            return
+
+        tid = rnd.choice(list(self.active))
+        q = self.active[tid]
+        prefix = ts + 'INFO  [HiveServer2-Background-Pool: Thread-{}]: '.format(tid)
+
+        if q['step'] == 'compile':
+            self.qid += 1
+            q['queryid'] = 'hive_{}_{}'.format(self.dt.strftime('%Y%m%d%H%M%S'), self.qid)
+            q['query'] = self.command()
+            q['step'] = 'started'
+            # The handler pool parses every command, successful ones are of no interest.
+            yield ts + 'INFO  [HiveServer2-Handler-Pool: Thread-{}]: parse.ParseDriver (ParseDriver.java:parse(185)) - Parsing command: {}\n'.format(
+                rnd.randint(30, 60), q['query'][0])
+            for c in q['query'][1:]:
+                yield c + '\n'
+            yield prefix + 'ql.Driver (Driver.java:execute(1390)) - Starting command(queryId={}): {}\n'.format(
+                q['queryid'], q['query'][0])
+            for c in q['query'][1:]:
+                yield c + '\n'
+        elif q['step'] == 'started':
+            self.txnid += 1
+            q['user'] = rnd.choice(USERS)
+            q['host'] = rnd.choice(HOSTS)
+            q['step'] = 'running'
+            yield prefix + 'lockmgr.DbTxnManager (DbTxnManager.java:acquireLocks(306)) - Setting lock request transaction to txnid:{}, user:{}, hostname:{}, for queryId={}\n'.format(
+                self.txnid, q['user'], q['host'], q['queryid'])
+        elif end or rnd.random() < 0.3:
+            duration = rnd.randint(5, 3600000)
+            yield prefix + 'log.PerfLogger (PerfLogger.java:PerfLogEnd(148)) - </PERFLOG method=Driver.run start=1453111200000 end=1453111201000 duration={} from=org.apache.hadoop.hive.ql.Driver>\n'.format(duration)
+            del self.active[tid]
+            yield {
+                'start': q['start'],
+                'user': q['user'],
+                'host': q['host'],
+                'duration': duration / 1000,
+                'status': 'Probably success',
+                'query': '\n'.join(q['query']),
+                'queryid': q['queryid'],
+            }
+        else:
+            yield prefix + 'ql.Driver (Driver.java:execute(1425)) - Executing command(queryId={}): {}\n'.format(
+                q['queryid'], q['query'][0])
+
+
+def parse_size(size):
+    """
+    Number of bytes from a human readable size, eg. 500KB, 100MB, 20GB.
+    """
+    m = re.match('(?P<n>\\d+(?:\\.\\d+)?)\\s*(?P<unit>[kmgt]?)b?$', size.strip().lower())
+    if not m:
+        raise(Exception('Size not understood: "{}"'.format(size)))
+    return int(float(m.group('n')) * 1024 ** ' kmgt'.index(m.group('unit') or ' '))
+
+
+def generate(outdir, size, days, start, compress, seed):
+    """
+    Writes the log files of days days, of about size bytes in total, and their expected queries.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    # Lines are about 160 bytes on average.
+    generator = LogGenerator(start, days * 86400, size // 160, seed=seed)
+
+    summary = {'lines': 0, 'bytes': 0, 'queries': 0, 'since': None, 'to': None, 'files': []}
+    out = None
+    day = None
+    with open(os.path.join(outdir, 'expected.jsonl'), 'w') as expected:
+        for item in generator.lines():
+            if isinstance(item, dict):
+                expected.write(json.dumps(item) + '\n')
+                summary['queries'] += 1
+                continue
+
+            if item[:1].isdigit():
+                if summary['since'] is None:
+                    summary['since'] = item[:19]
+                summary['to'] = item[:19]
+                if item[:10] != day:
+                    # Rolling to the file of the next day.
+                    day = item[:10]
+                    if out:
+                        out.close()
+                    path = os.path.join(outdir, 'hiveserver2.log.' + day + ('.gz' if compress else ''))
+                    out = gzip.open(path, 'wt', compresslevel=6) if compress else open(path, 'w')
+                    summary['files'].append(os.path.basename(path))
+            out.write(item)
+            summary['lines'] += 1
+            summary['bytes'] += len(item.encode())
+    out.close()
+
+    with open(os.path.join(outdir, 'expected.summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generates synthetic HiveServer2 logs, and the queries which should be extracted from them.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('outdir', type=str, help='Where to write the logs.')
+    parser.add_argument('--size', dest='size', type=str, default='100MB', help='Total size of the logs (uncompressed).')
+    parser.add_argument('--days', dest='days', type=int, default=2, help='Number of days (files) of logs.')
+    parser.add_argument('--start', dest='start', type=str, default='2016-01-18', help='Day of the first log line.')
+    parser.add_argument('--gzip', dest='gzip', action='store_true', help='Gzip the log files.')
+    parser.add_argument('--seed', dest='seed', type=int, default=42, help='Seed of the random generator.')
+    args = parser.parse_args()
+
+    summary = generate(
+        args.outdir,
+        parse_size(args.size),
+        args.days,
+        datetime.datetime.strptime(args.start, '%Y-%m-%d'),
+        args.gzip,
+        args.seed
+    )
+    print('{lines} lines, {bytes} bytes and {queries} queries written, from {since} to {to}.'.format(**summary))
+
+
+if __name__ == '__main__':
+    main()